@@ -0,0 +1,109 @@
+"""
+Incremental edit check: random same-count measure edits through
+Stepchart.edit_measures must give the same metadata as rebuilding the
+chart from scratch.
+
+    python benchmarks/incremental_check.py [--seeds 4] [--edits 420]
+
+Every chart in resources/ gets --edits random edits per seed, spread over
+its difficulties, and is compared to a rebuild every so often and at the
+end. Floats only have to agree to rounding, since the incremental sums
+add up in a different order. Exits non-zero on any mismatch.
+"""
+import argparse
+import copy
+import glob
+import math
+import os
+import random
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, "src"))
+
+from step_parser.stepchart import Stepchart  # noqa: E402
+
+STREAM_THRESHOLDS = [12, 16, 24]
+ROWS_PER_MEASURE = [4, 8, 12, 16, 24, 32]
+# weighted towards empty slots and taps, with holds, rolls, ends and mines
+SLOTS = "0000000000111122334M"
+CHECK_EVERY = 20
+
+
+def random_measure(rng):
+    return [
+        "".join(rng.choice(SLOTS) for _ in range(4))
+        for _ in range(rng.choice(ROWS_PER_MEASURE))
+    ]
+
+
+def random_edit(rng, stepchart):
+    """(difficulty, start, end, new_measures) replacing 1-3 measures with as many"""
+    difficulty = rng.choice(stepchart.difficulties)
+    if "measure_list" not in stepchart.charts[difficulty]:
+        stepchart._generate_measures(difficulty)
+    measure_count = len(stepchart.charts[difficulty]["measure_list"])
+    length = rng.randint(1, min(3, measure_count))
+    start = rng.randrange(measure_count - length + 1)
+    return difficulty, start, start + length, [random_measure(rng) for _ in range(length)]
+
+
+def same_value(a, b):
+    if isinstance(a, float) and isinstance(b, float):
+        return math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-9)
+    return a == b
+
+
+def mismatches(stepchart):
+    """Metadata keys where stepchart differs from a rebuild of it"""
+    rebuilt = copy.deepcopy(stepchart)
+    rebuilt._rebuild_metadata()
+    found = []
+    for key in set(stepchart.metadata) | set(rebuilt.metadata):
+        edited, expected = stepchart.metadata.get(key), rebuilt.metadata.get(key)
+        if isinstance(expected, dict) and isinstance(edited, dict):
+            found.extend(
+                f"{key}.{feature}: {edited.get(feature)!r} != {expected.get(feature)!r}"
+                for feature in set(edited) | set(expected)
+                if not same_value(edited.get(feature), expected.get(feature))
+            )
+        elif not same_value(edited, expected):
+            found.append(f"{key}: {edited!r} != {expected!r}")
+    return found
+
+
+def check_chart(path, seed, edits):
+    rng = random.Random(seed)
+    stepchart = Stepchart(path, stream_note_thresholds=STREAM_THRESHOLDS)
+    for edit_number in range(1, edits + 1):
+        stepchart.edit_measures(*random_edit(rng, stepchart))
+        if edit_number % CHECK_EVERY == 0 or edit_number == edits:
+            found = mismatches(stepchart)
+            if found:
+                return edit_number, found
+    return None, []
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seeds", type=int, default=4)
+    parser.add_argument("--edits", type=int, default=420)
+    args = parser.parse_args()
+
+    failed = 0
+    for path in sorted(glob.glob(os.path.join(ROOT_DIR, "resources", "*.sm"))):
+        for seed in range(args.seeds):
+            edit_number, found = check_chart(path, seed, args.edits)
+            name = os.path.basename(path)
+            if found:
+                failed += 1
+                print(f"{name} (seed {seed}): mismatch after edit {edit_number}")
+                for line in sorted(found):
+                    print(f"    {line}")
+            else:
+                print(f"{name} (seed {seed}): ok")
+    sys.exit(f"{failed} incremental check(s) failed" if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Startup benchmark: how long it takes to import step_parser and to get
+the CLI to the point of parsing arguments, in fresh interpreters.
+
+    python benchmarks/startup.py [--runs 10]
+
+The parsing core must not pull in pandas; this fails if it does.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+
+CASES = {
+    "import step_parser": "import step_parser",
+    "import step_parser.cli": "import step_parser.cli",
+}
+
+CHECK_NO_PANDAS = (
+    "import sys, step_parser, step_parser.cli; "
+    "sys.exit('pandas imported at startup' if 'pandas' in sys.modules else 0)"
+)
+
+
+def time_case(statement, runs):
+    """
+    Median wall time (ms) of running `statement` in a fresh interpreter,
+    timed inside it, so interpreter startup itself isn't included
+    """
+    timer = (
+        "import time; _start = time.perf_counter(); {}; "
+        "print((time.perf_counter() - _start) * 1000)"
+    ).format(statement)
+    env = dict(os.environ, PYTHONPATH=SRC_DIR)
+    samples = []
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-c", timer], env=env, stdout=subprocess.PIPE, universal_newlines=True, check=True
+        )
+        samples.append(float(result.stdout.strip()))
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=SRC_DIR)
+    subprocess.run([sys.executable, "-c", CHECK_NO_PANDAS], env=env, check=True)
+
+    for name, statement in CASES.items():
+        print(f"{name:<28} {time_case(statement, args.runs):8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
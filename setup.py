@@ -20,9 +20,11 @@ setuptools.setup(
     package_dir={"": "src"},
     packages=setuptools.find_packages(where="src"),
     python_requires=">=3.6",
-    install_requires=[
-        'pandas',
-    ],
+    install_requires=[],
+    extras_require={
+        'pandas': ['pandas'],
+        'numpy': ['numpy'],
+    },
     entry_points={
         'console_scripts': ['step_parser=step_parser.cli:step_parser_cli'],
     }
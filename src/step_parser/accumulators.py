@@ -0,0 +1,345 @@
+"""
+Fixed memory, mergeable statistics for streams of numbers.
+
+    RunningStats    - count, mean, variance (Welford), min, max
+    IntegerStats    - count, mean, variance and max of whole numbers,
+                      exact, and values can be removed again
+    QuantileSketch  - approximate quantiles (KLL sketch), exact until
+                      it first has to compact
+    LibrarySummary  - RunningStats + QuantileSketch for every numeric
+                      feature of a batch_analysis run
+
+All of them can be merged, so stats computed on separate shards or
+workers combine into the same result as one pass over all the data, and
+they round trip through plain dicts (to_dict/from_dict) for storage.
+"""
+import math
+
+
+class RunningStats(object):
+    """Welford's online mean/variance, plus count, min and max"""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Combine with stats from another stream (Chan et al.)"""
+        if not other.count:
+            return self
+        if not self.count:
+            self.count, self.mean, self.m2 = other.count, other.mean, other.m2
+            self.min, self.max = other.min, other.max
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    @property
+    def variance(self):
+        """Sample variance, like statistics.variance"""
+        if self.count < 2:
+            return None
+        return self.m2 / (self.count - 1)
+
+    @property
+    def std(self):
+        """Sample standard deviation, like statistics.stdev"""
+        variance = self.variance
+        return None if variance is None else math.sqrt(variance)
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "m2": self.m2,
+            "min": self.min,
+            "max": self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        stats.count = data["count"]
+        stats.mean = data["mean"]
+        stats.m2 = data["m2"]
+        stats.min = data["min"]
+        stats.max = data["max"]
+        return stats
+
+
+class IntegerStats(object):
+    """
+    count, total, sum of squares and max of whole numbers, eg. stream
+    lengths in measures. The sums are ints, so they never drift: the mean is
+    one division and the variance one division and a sqrt away. Values can
+    be removed as well as added, for runs that change after an edit.
+    """
+
+    def __init__(self, values=()):
+        self.count = 0
+        self.total = 0
+        self.total_squares = 0
+        self.value_counts = {}  # value: count, for max after a removal
+        for value in values:
+            self.add(value)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.total_squares += value * value
+        self.value_counts[value] = self.value_counts.get(value, 0) + 1
+
+    def remove(self, value):
+        self.count -= 1
+        self.total -= value
+        self.total_squares -= value * value
+        self.value_counts[value] -= 1
+        if not self.value_counts[value]:
+            del self.value_counts[value]
+
+    @property
+    def max(self):
+        return max(self.value_counts) if self.value_counts else None
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    @property
+    def variance(self):
+        """Sample variance, like statistics.variance"""
+        if self.count < 2:
+            return None
+        return (self.count * self.total_squares - self.total * self.total) / (self.count * (self.count - 1))
+
+    @property
+    def std(self):
+        """Sample standard deviation, like statistics.stdev"""
+        variance = self.variance
+        return None if variance is None else math.sqrt(variance)
+
+
+class QuantileSketch(object):
+    """
+    KLL quantile sketch. Memory stays around 3k values no matter how many
+    are added, and rank error is roughly 1.7 / k.
+
+    Values sit in a stack of compactors; an item at level h stands for 2**h
+    of the original values. When a level fills up it is sorted and every
+    other item is promoted to the next level. Which half is promoted
+    alternates instead of being random, so results are reproducible.
+
+    Until the first compaction every value is kept, and quantiles are exact
+    (interpolated the same way as statistics.median).
+    """
+
+    def __init__(self, k=200):
+        self.k = k
+        self.count = 0
+        self.compactors = [[]]
+        self._size = 0
+        self._max_size = self._capacity(0)
+        self._promote_odd = False
+
+    def _capacity(self, level):
+        depth = len(self.compactors) - level - 1
+        return int(math.ceil(self.k * (2 / 3) ** depth)) + 1
+
+    def add(self, value):
+        self.compactors[0].append(value)
+        self.count += 1
+        self._size += 1
+        if self._size >= self._max_size:
+            self._compress()
+
+    def merge(self, other):
+        """Combine with a sketch of another stream"""
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append([])
+        for level, items in enumerate(other.compactors):
+            self.compactors[level].extend(items)
+        self.count += other.count
+        self._size = sum(len(items) for items in self.compactors)
+        self._update_max_size()
+        while self._size >= self._max_size:
+            self._compress()
+        return self
+
+    def _update_max_size(self):
+        self._max_size = sum(self._capacity(level) for level in range(len(self.compactors)))
+
+    def _compress(self):
+        for level, items in enumerate(self.compactors):
+            if len(items) >= self._capacity(level):
+                if level + 1 == len(self.compactors):
+                    self.compactors.append([])
+                items.sort()
+                promoted = items[int(self._promote_odd)::2]
+                self._promote_odd = not self._promote_odd
+                self.compactors[level + 1].extend(promoted)
+                self._size -= len(items) - len(promoted)
+                items.clear()
+                self._update_max_size()
+                break
+
+    @property
+    def exact(self):
+        return len(self.compactors) == 1
+
+    def quantile(self, q):
+        """Value at quantile q (0 <= q <= 1), or None if nothing was added"""
+        if not self.count:
+            return None
+        if self.exact:
+            values = sorted(self.compactors[0])
+            position = q * (len(values) - 1)
+            lower = int(math.floor(position))
+            upper = min(lower + 1, len(values) - 1)
+            if position == lower:
+                return values[lower]
+            return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+        weighted = sorted(
+            (value, 2 ** level)
+            for level, items in enumerate(self.compactors)
+            for value in items
+        )
+        total_weight = sum(weight for _, weight in weighted)
+        target = q * total_weight
+        cumulative_weight = 0
+        for value, weight in weighted:
+            cumulative_weight += weight
+            if cumulative_weight >= target:
+                return value
+        return weighted[-1][0]
+
+    def quantiles(self, qs):
+        return [self.quantile(q) for q in qs]
+
+    def to_dict(self):
+        return {
+            "k": self.k,
+            "count": self.count,
+            "compactors": [list(items) for items in self.compactors],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data["k"])
+        sketch.count = data["count"]
+        sketch.compactors = [list(items) for items in data["compactors"]]
+        sketch._size = sum(len(items) for items in sketch.compactors)
+        sketch._update_max_size()
+        return sketch
+
+
+def median(sorted_values):
+    """Median of an already sorted list, like statistics.median. None if it's empty"""
+    if not sorted_values:
+        return None
+    middle = len(sorted_values) // 2
+    if len(sorted_values) % 2:
+        return sorted_values[middle]
+    return (sorted_values[middle - 1] + sorted_values[middle]) / 2
+
+
+def mode(counts):
+    """
+    Most common value of a {value: count} dict. Ties go to the value that was
+    counted first, like statistics.mode. None if counts is empty.
+    """
+    if not counts:
+        return None
+    return max(counts.items(), key=lambda x: x[1])[0]
+
+
+class LibrarySummary(object):
+    """
+    Distribution of every numeric feature over a library of charts,
+    built one record at a time.
+    """
+
+    SUMMARY_QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+
+    def __init__(self, k=200):
+        self.k = k
+        self.stats = {}     # feature: RunningStats
+        self.sketches = {}  # feature: QuantileSketch
+
+    def add_record(self, record):
+        for key, value in record.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            if isinstance(value, float) and math.isnan(value):
+                continue
+            if key not in self.stats:
+                self.stats[key] = RunningStats()
+                self.sketches[key] = QuantileSketch(self.k)
+            self.stats[key].add(value)
+            self.sketches[key].add(value)
+
+    def merge(self, other):
+        for key, stats in other.stats.items():
+            if key not in self.stats:
+                self.stats[key] = RunningStats()
+                self.sketches[key] = QuantileSketch(self.k)
+            self.stats[key].merge(stats)
+            self.sketches[key].merge(other.sketches[key])
+        return self
+
+    def summary(self):
+        """
+        {feature: {"count", "mean", "std", "min", "max", "p1", "p5", ...}}
+        """
+        summary = {}
+        for key, stats in self.stats.items():
+            feature_summary = {
+                "count": stats.count,
+                "mean": stats.mean,
+                "std": stats.std,
+                "min": stats.min,
+                "max": stats.max,
+            }
+            for q, value in zip(self.SUMMARY_QUANTILES, self.sketches[key].quantiles(self.SUMMARY_QUANTILES)):
+                feature_summary[f"p{int(q * 100)}"] = value
+            summary[key] = feature_summary
+        return summary
+
+    def to_dict(self):
+        return {
+            "k": self.k,
+            "features": {
+                key: {
+                    "stats": stats.to_dict(),
+                    "sketch": self.sketches[key].to_dict(),
+                }
+                for key, stats in self.stats.items()
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        library_summary = cls(data["k"])
+        for key, feature in data["features"].items():
+            library_summary.stats[key] = RunningStats.from_dict(feature["stats"])
+            library_summary.sketches[key] = QuantileSketch.from_dict(feature["sketch"])
+        return library_summary
@@ -0,0 +1,161 @@
+import os
+import tarfile
+import zipfile
+import zlib
+
+
+ZIP_EXTENSIONS = (".zip",)
+TAR_EXTENSIONS = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+
+# archive.zip!/Pack/Song/Song.sm
+ARCHIVE_SEPARATOR = "!/"
+
+# damaged, truncated or encrypted archives, and archives that aren't what
+# their extension says
+ARCHIVE_ERRORS = (
+    zipfile.BadZipFile,
+    zipfile.LargeZipFile,
+    tarfile.TarError,
+    RuntimeError,           # encrypted zip member
+    NotImplementedError,    # unsupported zip compression
+    EOFError,
+    OSError,
+    zlib.error,
+)
+
+
+def is_archive(path):
+    """True if `path` looks like a zip or tar song pack, by file extension"""
+    lower_path = path.lower()
+    return lower_path.endswith(ZIP_EXTENSIONS + TAR_EXTENSIONS)
+
+
+def iter_archive_sm_files(archive_path, on_error=None):
+    """
+    Yield every .sm member of a zip or tar archive without extracting it.
+
+    Zip members are found through the central directory, so audio and
+    other large members are never read. Tars are read as a stream, one
+    pass over the archive.
+
+    Each yielded file object is only valid until the next item is requested.
+
+    :param archive_path: path to a .zip or .tar(.gz/.bz2/.xz) file
+    :param on_error:
+        called as on_error(name, exception) when the archive (name is the
+        archive path) or one of its members (name is the member's name, as
+        below) can't be read, and reading carries on with the next archive
+        or member. If None, the exception is raised.
+    :return: generator of (name, binary file object, size in bytes), eg.
+        ("packs/Pack.zip!/Pack/Song/Song.sm", <file>, 48213)
+    """
+    if archive_path.lower().endswith(ZIP_EXTENSIONS):
+        try:
+            archive = zipfile.ZipFile(archive_path)
+        except ARCHIVE_ERRORS as e:
+            _archive_error(on_error, archive_path, e)
+            return
+        with archive:
+            for info in archive.infolist():
+                if info.is_dir() or not info.filename.lower().endswith(".sm"):
+                    continue
+                name = f"{archive_path}{ARCHIVE_SEPARATOR}{info.filename}"
+                try:
+                    # encrypted members and unknown compression fail here
+                    f = archive.open(info)
+                except ARCHIVE_ERRORS as e:
+                    _archive_error(on_error, name, e)
+                    continue
+                with f:
+                    yield name, f, info.file_size
+    elif archive_path.lower().endswith(TAR_EXTENSIONS):
+        try:
+            archive = tarfile.open(archive_path, "r|*")
+        except ARCHIVE_ERRORS as e:
+            _archive_error(on_error, archive_path, e)
+            return
+        with archive:
+            members = iter(archive)
+            while True:
+                # a stream can't skip past damage, so the rest of the tar is lost
+                try:
+                    member = next(members, None)
+                except ARCHIVE_ERRORS as e:
+                    _archive_error(on_error, archive_path, e)
+                    return
+                if member is None:
+                    return
+                if not member.isfile() or not member.name.lower().endswith(".sm"):
+                    continue
+                f = archive.extractfile(member)
+                yield f"{archive_path}{ARCHIVE_SEPARATOR}{member.name}", f, member.size
+    else:
+        raise ValueError(f"Unsupported archive type: {archive_path}")
+
+
+def _archive_error(on_error, name, exception):
+    if on_error is None:
+        raise exception
+    on_error(name, exception)
+
+
+def iter_sm_sources(target, on_error=None):
+    """
+    Yield every .sm file under `target`, which may be a directory, a
+    song pack archive, or a single .sm file. Archives found while walking
+    a directory are read in place.
+
+    :param on_error: handler for unreadable archives, see iter_archive_sm_files
+    :return: generator of (name, source, size in bytes), where source is
+        a path or a binary file object (see iter_archive_sm_files)
+    """
+    if os.path.isfile(target):
+        if is_archive(target):
+            yield from iter_archive_sm_files(target, on_error)
+        elif target.endswith(".sm"):
+            yield target, target, os.path.getsize(target)
+        return
+
+    for root, dirs, files in os.walk(target):
+        for name in files:
+            file_path = os.path.join(root, name)
+            if file_path.endswith(".sm"):
+                yield file_path, file_path, os.path.getsize(file_path)
+            elif is_archive(file_path):
+                yield from iter_archive_sm_files(file_path, on_error)
+
+
+def count_sm_sources(target):
+    """
+    Number of .sm files iter_sm_sources(target) will yield, or None if
+    target contains tar archives (counting those means reading them).
+    Zips are counted from their central directory. A zip that can't be
+    opened counts as one file, the error iter_sm_sources will report for it.
+    """
+    if os.path.isfile(target):
+        archives = [target] if is_archive(target) else []
+        sm_count = int(target.endswith(".sm"))
+    else:
+        archives = []
+        sm_count = 0
+        for root, dirs, files in os.walk(target):
+            for name in files:
+                if name.endswith(".sm"):
+                    sm_count += 1
+                elif is_archive(name):
+                    archives.append(os.path.join(root, name))
+
+    for archive_path in archives:
+        if not archive_path.lower().endswith(ZIP_EXTENSIONS):
+            return None
+        try:
+            archive = zipfile.ZipFile(archive_path)
+        except ARCHIVE_ERRORS:
+            sm_count += 1
+            continue
+        with archive:
+            sm_count += sum(
+                1 for info in archive.infolist()
+                if not info.is_dir() and info.filename.lower().endswith(".sm")
+            )
+    return sm_count
@@ -6,17 +6,123 @@ import time
 pkg_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(pkg_dir)
 
+from step_parser.rating_model import RatingModel
 from step_parser.stepchart import batch_analysis
 
 
-def step_parser_cli():
-    parser = argparse.ArgumentParser()
+def parse_thresholds(value):
+    """Parse "12,16,24" into [12, 16, 24]"""
+    try:
+        return [int(i) for i in value.split(",") if i.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid threshold list: {value}")
+
+
+def positive_int(value):
+    """Parse an int of at least 1"""
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int: {value}")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1: {value}")
+    return number
+
+
+def positive_float(value):
+    """Parse a float greater than 0"""
+    try:
+        number = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid float: {value}")
+    if not number > 0:
+        raise argparse.ArgumentTypeError(f"must be greater than 0: {value}")
+    return number
+
+
+def fit_cli(argv):
+    """step_parser fit features.csv --model rating_model.json"""
+    parser = argparse.ArgumentParser(prog="step_parser fit", description="fit a rating model on step_parser output")
+    parser.add_argument("features", help="csv written by step_parser")
+    parser.add_argument("--model", default="rating_model.json", help="where to save the model")
+    parser.add_argument("--alpha", type=positive_float, default=1.0, help="ridge penalty, greater than 0")
+    args = parser.parse_args(argv)
+
+    model = RatingModel.fit_csv(args.features, alpha=args.alpha)
+    training = model.training
+    fit_stats = f"rmse {training['rmse']:.3f}"
+    if training["r2"] is not None:
+        fit_stats += f", r2 {training['r2']:.3f}"
+    print(f"Fit on {training['count']} charts: {fit_stats}")
+    print(f"Writing model to {args.model}")
+    model.save(args.model)
+
+
+def score_cli(argv):
+    """step_parser score rating_model.json features.csv"""
+    parser = argparse.ArgumentParser(prog="step_parser score", description="predict ratings for step_parser output")
+    parser.add_argument("model", help="model saved by step_parser fit")
+    parser.add_argument("features", help="csv written by step_parser")
+    parser.add_argument("--output", default=f"step_parser_scores_{int(time.time())}.csv")
+    args = parser.parse_args(argv)
+
+    start = time.monotonic()
+    scored = RatingModel.load(args.model).score_csv(args.features, args.output)
+    print(f"Scored {scored} charts in {time.monotonic() - start:.1f}s, written to {args.output}")
+
+
+COMMANDS = {
+    "fit": fit_cli,
+    "score": score_cli,
+}
+
+
+def step_parser_cli(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] in COMMANDS:
+        return COMMANDS[argv[0]](argv[1:])
+
+    parser = argparse.ArgumentParser(
+        epilog="other commands: step_parser fit ..., step_parser score ... (see step_parser <command> -h)",
+    )
     parser.add_argument("target_dir")
     parser.add_argument("--output", default=f"step_parser_output_{int(time.time())}.csv")
     parser.add_argument("--raise-on-unknown-failure", action="store_true")
-    args = parser.parse_args()
+    parser.add_argument(
+        "--stream-thresholds",
+        type=parse_thresholds,
+        default=None,
+        help="comma separated stream note thresholds to sweep, eg. 12,16,24,32",
+    )
+    parser.add_argument(
+        "--summary",
+        default=None,
+        help="also write a json summary of every feature's distribution over the library",
+    )
+    parser.add_argument(
+        "--progress-json",
+        default=None,
+        help="write machine readable progress events to this file as JSON lines",
+    )
+    parser.add_argument(
+        "--ngrams",
+        default=None,
+        help="also write arrow n-gram counts per chart to this sparse Matrix Market (.mtx) file",
+    )
+    parser.add_argument("--ngram-max-length", type=positive_int, default=8)
+    args = parser.parse_args(argv)
 
-    batch_analysis(args.target_dir, args.output, args.raise_on_unknown_failure)
+    batch_analysis(
+        args.target_dir,
+        args.output,
+        args.raise_on_unknown_failure,
+        args.stream_thresholds,
+        as_dataframe=False,
+        summary_file=args.summary,
+        progress_json=args.progress_json,
+        ngram_file=args.ngrams,
+        ngram_max_length=args.ngram_max_length,
+    )
 
 
 if __name__ == "__main__":
@@ -3,6 +3,10 @@ import os
 
 ROOT_DIR = os.path.abspath(os.sep)
 ERROR_LOG = "sm_tools_error.log"
+# .sm files are read as this, whether they come from a path, bytes or a binary file
+SM_ENCODING = "utf-8"
+# csv files are written (and read back) as this, like DataFrame.to_csv, whatever the locale
+CSV_ENCODING = "utf-8"
 
 # These numbers in a stepchart indicate notes that require stepping on
 # 1 = note, 2 = hold, 4 = roll
@@ -0,0 +1,364 @@
+"""
+Hold and roll ("freeze") lifetimes.
+
+A freeze starts at a 2 (hold) or 4 (roll) and lasts until the next 3 in
+the same column, or until another note in that column cuts it off. FreezeTracker follows them row by row while a chart is
+read, counting the notes that have to be hit while a freeze is held, and
+collects every freeze into a FreezeIndex for later queries.
+"""
+from bisect import bisect_left
+from collections import namedtuple
+
+from step_parser.constants import NOTE_TYPES
+from step_parser.quantization import measure_quantization
+from step_parser.rows import row_info
+
+
+FREEZE_KINDS = {"2": "hold", "4": "roll"}
+FREEZE_END = "3"
+# a 3 ends a held freeze, and a tap in its column cuts it off
+FREEZE_CUTS = (FREEZE_END, "1")
+
+Freeze = namedtuple("Freeze", [
+    "kind",             # "hold" or "roll"
+    "column",           # 0-3, LDUR
+    "start_measure",
+    "start_row",        # row within start_measure
+    "end_measure",
+    "end_row",
+    "start_beat",       # float. The same row always gets the same float
+    "end_beat",
+    "start_seconds",
+    "end_seconds",
+])
+
+
+# segment tree node over a range of measures:
+# (change in held freezes, peak held relative to the range start,
+#  lowest held relative to the range start, seconds spent at that lowest level,
+#  seconds, hold seconds, roll seconds)
+EMPTY_NODE = (0, float("-inf"), float("inf"), 0.0, 0.0, 0.0, 0.0)
+
+
+def _combine(left, right):
+    right_low = left[0] + right[2]
+    low = min(left[2], right_low)
+    return (
+        left[0] + right[0],
+        max(left[1], left[0] + right[1]),
+        low,
+        (left[3] if left[2] == low else 0.0) + (right[3] if right_low == low else 0.0),
+        left[4] + right[4],
+        left[5] + right[5],
+        left[6] + right[6],
+    )
+
+
+class FreezeIndex(object):
+    """
+    Interval index over a chart's freezes. A freeze is held at beats
+    start_beat < beat <= end_beat: its head is a normal note, and notes on
+    its end row still have to be hit while it's held down.
+
+    Freezes in a column never overlap (a new head ends the column's held
+    freeze), so each column's freezes are sorted by start and end at once,
+    and lookups are a bisect per column.
+
+    Chart totals (max_concurrent, hold/roll/held seconds) come from a
+    segment tree with a leaf per measure. Each leaf summarizes the freeze
+    heads and ends in its measure. replace() only recomputes the leaves of
+    the measures where the changed freezes start and end.
+    """
+
+    def __init__(self, freezes, measure_count, timing_map):
+        """
+        :param freezes:         Freeze tuples
+        :param measure_count:   measures in the chart
+        :param timing_map:      TimingMap of the song
+        """
+        self.measure_count = measure_count
+        self._starts = [[] for _ in range(4)]   # per column, sorted
+        self._ends = [[] for _ in range(4)]
+        self._column_freezes = [[] for _ in range(4)]
+
+        # a slot per measure, plus one at the end of the chart for freezes
+        # that are never ended
+        slots = measure_count + 1
+        self._slot_seconds = [timing_map.seconds_at(4 * measure) for measure in range(slots)]
+        self._slot_seconds.append(self._slot_seconds[-1])
+        self._slot_events = [[] for _ in range(slots)]    # (beat, change, column, freeze)
+        for freeze in sorted(freezes, key=lambda x: (x.column, x.start_beat)):
+            self._insert(freeze)
+
+        self._size = 1
+        while self._size < slots:
+            self._size *= 2
+        self._nodes = [EMPTY_NODE] * (2 * self._size)
+        for slot in range(slots):
+            self._nodes[self._size + slot] = self._leaf(slot)
+        for i in range(self._size - 1, 0, -1):
+            self._nodes[i] = _combine(self._nodes[2 * i], self._nodes[2 * i + 1])
+
+    def __len__(self):
+        return sum(len(freezes) for freezes in self._column_freezes)
+
+    @property
+    def freezes(self):
+        """Every freeze, ordered by start beat then column"""
+        return sorted(
+            (freeze for freezes in self._column_freezes for freeze in freezes),
+            key=lambda x: (x.start_beat, x.column),
+        )
+
+    def _insert(self, freeze):
+        i = bisect_left(self._starts[freeze.column], freeze.start_beat)
+        self._starts[freeze.column].insert(i, freeze.start_beat)
+        self._ends[freeze.column].insert(i, freeze.end_beat)
+        self._column_freezes[freeze.column].insert(i, freeze)
+        self._slot_events[freeze.start_measure].append((freeze.start_beat, 1, freeze.column, freeze))
+        self._slot_events[freeze.end_measure].append((freeze.end_beat, -1, freeze.column, freeze))
+
+    def _remove(self, freeze):
+        i = bisect_left(self._starts[freeze.column], freeze.start_beat)
+        del self._starts[freeze.column][i]
+        del self._ends[freeze.column][i]
+        del self._column_freezes[freeze.column][i]
+        for slot in (freeze.start_measure, freeze.end_measure):
+            self._slot_events[slot] = [event for event in self._slot_events[slot] if event[3] != freeze]
+
+    def replace(self, removed, added):
+        """Remove freezes `removed` (all in the index) and add freezes `added`"""
+        changed_slots = set()
+        for freeze in removed:
+            self._remove(freeze)
+            changed_slots.update((freeze.start_measure, freeze.end_measure))
+        for freeze in added:
+            self._insert(freeze)
+            changed_slots.update((freeze.start_measure, freeze.end_measure))
+        for slot in changed_slots:
+            i = self._size + slot
+            self._nodes[i] = self._leaf(slot)
+            i //= 2
+            while i >= 1:
+                self._nodes[i] = _combine(self._nodes[2 * i], self._nodes[2 * i + 1])
+                i //= 2
+
+    def _leaf(self, slot):
+        """Segment tree node for the freeze heads and ends in one measure"""
+        # ends sort before heads on the same beat: a freeze ending where
+        # another one starts doesn't overlap it
+        events = sorted(self._slot_events[slot], key=lambda x: x[:3])
+        held = peak = low = 0
+        low_seconds = seconds = hold_seconds = roll_seconds = 0.0
+        previous_seconds = self._slot_seconds[slot]
+        for beat, change, _, freeze in events:
+            if change == 1:
+                event_seconds = freeze.start_seconds
+                if freeze.kind == "hold":
+                    hold_seconds += freeze.end_seconds - freeze.start_seconds
+                else:
+                    roll_seconds += freeze.end_seconds - freeze.start_seconds
+            else:
+                event_seconds = freeze.end_seconds
+            length = event_seconds - previous_seconds
+            seconds += length
+            if held == low:
+                low_seconds += length
+            previous_seconds = event_seconds
+            held += change
+            peak = max(peak, held)
+            if held < low:
+                low, low_seconds = held, 0.0
+        length = self._slot_seconds[slot + 1] - previous_seconds
+        seconds += length
+        if held == low:
+            low_seconds += length
+        return held, peak, low, low_seconds, seconds, hold_seconds, roll_seconds
+
+    @property
+    def max_concurrent(self):
+        """Most freezes held at once"""
+        return self._nodes[1][1]
+
+    @property
+    def hold_seconds(self):
+        return self._nodes[1][5]
+
+    @property
+    def roll_seconds(self):
+        return self._nodes[1][6]
+
+    @property
+    def held_seconds(self):
+        """Seconds during which at least one freeze is held"""
+        _, _, low, low_seconds, seconds, _, _ = self._nodes[1]
+        # nothing is held before the first head, so the lowest level is 0
+        return seconds - low_seconds if low == 0 else seconds
+
+    def total_seconds(self, kind=None):
+        """Summed length of every freeze (or every freeze of one kind)"""
+        if kind == "hold":
+            return self.hold_seconds
+        if kind == "roll":
+            return self.roll_seconds
+        return self.hold_seconds + self.roll_seconds
+
+    def held_at(self, beat):
+        """Freezes held at `beat`, O(log n)"""
+        held = []
+        for starts, ends, freezes in zip(self._starts, self._ends, self._column_freezes):
+            i = bisect_left(starts, beat) - 1
+            if i >= 0 and ends[i] >= beat:
+                held.append(freezes[i])
+        return held
+
+    def overlapping(self, start_beat, end_beat):
+        """Freezes held at any point in [start_beat, end_beat], O(log n) plus one step per freeze found"""
+        found = []
+        for starts, ends, freezes in zip(self._starts, self._ends, self._column_freezes):
+            i = bisect_left(ends, start_beat)
+            while i < len(freezes) and starts[i] < end_beat:
+                found.append(freezes[i])
+                i += 1
+        return found
+
+    def active_count(self, beat):
+        """Number of freezes held at `beat`, O(log n)"""
+        return len(self.held_at(beat))
+
+    def overlap_count(self, start_beat, end_beat):
+        """Number of freezes held at any point in [start_beat, end_beat], O(log n)"""
+        return sum(
+            max(bisect_left(starts, end_beat) - bisect_left(ends, start_beat), 0)
+            for starts, ends in zip(self._starts, self._ends)
+        )
+
+    def ended_in(self, start, end):
+        """Freezes that end in measures [start, end) (measure_count for never ended ones)"""
+        return [
+            event[3]
+            for slot in range(start, min(end, self.measure_count + 1))
+            for event in self._slot_events[slot]
+            if event[1] == -1
+        ]
+
+
+class FreezeTracker(object):
+    """
+    Follows freezes through a chart, one row at a time.
+
+    Freeze-aware counts classify each row with notes by its notes plus the
+    freezes held during it, like StepMania does: 2 = jump, 3 = hand, 4 = quad.
+    eg. a jump while holding a freeze is a hand. Rows without held freezes
+    classify the same either way, so only the difference is tracked.
+
+    A note in a held column re-heads (a 2 or 4) or cuts off (a 1) that
+    column's own freeze, so only freezes held in the row's other columns
+    count for it.
+    """
+
+    def __init__(self, timing_map):
+        self.timing_map = timing_map
+        self.held = {}          # column: (kind, start_measure, start_row, start_beat)
+        self.freezes = []
+        self.freeze_notes = 0   # notes hit while a freeze is held
+        # changes to note-only jump/hand/quad counts (see detect_jumps_hands_quads)
+        # once held freezes are counted
+        self.jump_hand_quad_changes = [0, 0, 0]
+
+    def needs_row(self, subdivision, info=None):
+        """False for rows that can't change anything. Cheap, to skip add_row on most rows"""
+        return bool(self.held) or (info or row_info(subdivision)).freeze_slots
+
+    def add_row(self, subdivision, measure_number, row, measure_beat, info=None):
+        """
+        :param subdivision:     row of the chart, eg. "1030"
+        :param measure_number:  measure the row is in
+        :param row:             row number within the measure
+        :param measure_beat:    beat of the row within its measure (Fraction)
+        :param info:            the row's rows.RowInfo, if the caller already has it
+        """
+        notes = (info or row_info(subdivision)).notes
+        if notes and self.held:
+            held = sum(1 for column in self.held if subdivision[column] not in NOTE_TYPES)
+            if held:
+                self.freeze_notes += notes
+                self._change_row_class(notes, -1)
+                self._change_row_class(notes + held, 1)
+
+        for column, slot in enumerate(subdivision[:4]):
+            if slot in FREEZE_CUTS and column in self.held:
+                self._close(column, measure_number, row, float(4 * measure_number + measure_beat))
+            elif slot in FREEZE_KINDS:
+                beat = float(4 * measure_number + measure_beat)
+                if column in self.held:
+                    self._close(column, measure_number, row, beat)
+                self.held[column] = (FREEZE_KINDS[slot], measure_number, row, beat)
+
+    def _change_row_class(self, arrows, change):
+        if arrows >= 2:
+            self.jump_hand_quad_changes[min(arrows, 4) - 2] += change
+
+    def hold(self, freeze):
+        """Start tracking from a point where `freeze` is already held"""
+        self.held[freeze.column] = (freeze.kind, freeze.start_measure, freeze.start_row, freeze.start_beat)
+
+    def _close(self, column, end_measure, end_row, end_beat):
+        kind, start_measure, start_row, start_beat = self.held.pop(column)
+        self.freezes.append(Freeze(
+            kind,
+            column,
+            start_measure,
+            start_row,
+            end_measure,
+            end_row,
+            start_beat,
+            end_beat,
+            self.timing_map.seconds_at(start_beat),
+            self.timing_map.seconds_at(end_beat),
+        ))
+
+    def finish(self, measure_count):
+        """
+        Close freezes that never got a 3 at the end of the chart,
+        and return the FreezeIndex
+        """
+        for column in list(self.held):
+            self._close(column, measure_count, 0, float(4 * measure_count))
+        return FreezeIndex(self.freezes, measure_count, self.timing_map)
+
+
+def track_measure_freezes(tracker, measure, measure_number, row_infos=None):
+    """
+    Feed one measure to a FreezeTracker.
+
+    :param row_infos:   the measure's rows.RowInfo list, if the caller already has it
+    :return: (freeze_notes, jump_hand_quad_changes) added by this measure
+    """
+    freeze_notes = tracker.freeze_notes
+    changes = list(tracker.jump_hand_quad_changes)
+    if row_infos is None:
+        row_infos = [row_info(subdivision) for subdivision in measure]
+    for row, (subdivision, info, (beat, _)) in enumerate(
+        zip(measure, row_infos, measure_quantization(len(measure)))
+    ):
+        if tracker.needs_row(subdivision, info):
+            tracker.add_row(subdivision, measure_number, row, beat, info)
+    return (
+        tracker.freeze_notes - freeze_notes,
+        [new - old for new, old in zip(tracker.jump_hand_quad_changes, changes)],
+    )
+
+
+def track_freezes(measure_list, timing_map):
+    """
+    Run a FreezeTracker over a whole list of measures.
+
+    :return: (FreezeIndex, per measure list of (freeze_notes, jump_hand_quad_changes))
+    """
+    tracker = FreezeTracker(timing_map)
+    measure_freezes = [
+        track_measure_freezes(tracker, measure, measure_number)
+        for measure_number, measure in enumerate(measure_list)
+    ]
+    return tracker.finish(len(measure_list)), measure_freezes
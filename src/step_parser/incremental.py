@@ -0,0 +1,533 @@
+"""
+Incremental re-analysis of a Stepchart after measure edits.
+
+A full Stepchart build scans every measure of every difficulty. When a
+chart editor changes a few measures, IncrementalChart keeps per-measure
+values in prefix/segment trees and patches only the aggregates the edit
+touches:
+
+    * step, jump/hand/quad, mine, hold, roll and snap counts  (FenwickTree)
+    * notes per second per measure                            (SegmentTree)
+    * stream breakdowns and stats                             (StreamRuns)
+    * tech patterns, re-read from the TechPatternCounter state saved
+      before the edit, until the state after a measure matches again
+    * hold/roll features, re-tracked from the nearest freeze head before
+      the edit, and only when the edit overlaps a freeze or adds/removes one
+"""
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter, namedtuple
+
+from step_parser.accumulators import IntegerStats, median
+from step_parser.freezes import FreezeTracker, track_measure_freezes
+from step_parser.quantization import SNAP_LEVELS, measure_quantization, snaps_lcm
+from step_parser.rows import row_info
+from step_parser.step_patterns import NEW_GROUP_STATE, TechPatternCounter
+from step_parser.time_calculations import calculate_measure_nps
+
+
+JUMP_HAND_QUAD_KEYS = ["jumps", "hands", "quads", "mines", "holds", "rolls"]
+TECH_KEYS = ["crossovers", "footswitches", "crossover_footswitches", "jacks", "invalid_crossovers"]
+MeasureValues = namedtuple("MeasureValues", [
+    "note_count",               # rows with notes, for stream breakdowns
+    "step_count",               # notes, holds and rolls
+    "jump_hand_quad_counts",    # in JUMP_HAND_QUAD_KEYS order
+    "snap_counts",              # {snap: rows with notes on it}
+    "snap",                     # finest snap of the measure's notes, see quantization.snaps_lcm
+    "arrows",                   # generate_arrow_list string
+    "freeze_slots",             # has a row that can start or end a freeze
+])
+STREAM_STAT_KEYS = [
+    "stream_count", "stream_size_max", "stream_size_avg", "stream_size_std",
+    "break_count", "break_size_max", "break_size_avg", "break_total", "break_size_std",
+]
+
+
+class FenwickTree(object):
+    """Prefix sums over a list of numbers with O(log n) point updates"""
+
+    def __init__(self, values):
+        self.size = len(values)
+        self.values = list(values)
+        self.tree = [0] * (self.size + 1)
+        for i, value in enumerate(self.values, start=1):
+            self.tree[i] += value
+            parent = i + (i & -i)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[i]
+
+    def set(self, index, value):
+        delta = value - self.values[index]
+        self.values[index] = value
+        i = index + 1
+        while i <= self.size:
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix_sum(self, end):
+        """sum of values[:end]"""
+        total = 0
+        i = end
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def range_sum(self, start, end):
+        """sum of values[start:end]"""
+        return self.prefix_sum(end) - self.prefix_sum(start)
+
+    def total(self):
+        return self.prefix_sum(self.size)
+
+
+class SegmentTree(object):
+    """
+    Sum, sum of squares and max over a list of floats, with O(log n)
+    point updates and O(1) whole-list queries
+    """
+
+    def __init__(self, values):
+        self.size = len(values)
+        self.sums = [0.0] * (2 * self.size)
+        self.squares = [0.0] * (2 * self.size)
+        self.maxes = [float("-inf")] * (2 * self.size)
+        for i, value in enumerate(values):
+            self.sums[self.size + i] = value
+            self.squares[self.size + i] = value * value
+            self.maxes[self.size + i] = value
+        for i in range(self.size - 1, 0, -1):
+            self._pull(i)
+
+    def _pull(self, i):
+        left, right = 2 * i, 2 * i + 1
+        self.sums[i] = self.sums[left] + self.sums[right]
+        self.squares[i] = self.squares[left] + self.squares[right]
+        self.maxes[i] = max(self.maxes[left], self.maxes[right])
+
+    def set(self, index, value):
+        i = self.size + index
+        self.sums[i] = value
+        self.squares[i] = value * value
+        self.maxes[i] = value
+        i //= 2
+        while i >= 1:
+            self._pull(i)
+            i //= 2
+
+    # node 1 aggregates every leaf (for a single value, node 1 is the leaf)
+    def total(self):
+        return self.sums[1]
+
+    def total_squares(self):
+        return self.squares[1]
+
+    def max(self):
+        return self.maxes[1]
+
+
+class StreamRuns(object):
+    """
+    Alternating runs of stream / break measures for one stream threshold,
+    spliced locally when measures change. Run sizes are kept in a pair of
+    IntegerStats, adjusted for just the spliced runs, so the stream stats
+    never need the whole breakdown.
+    """
+
+    def __init__(self, measure_note_counts, threshold):
+        self.threshold = threshold
+        self.runs = []      # [is_stream, length]
+        self.starts = []    # first measure of each run
+        self._append_runs(self.runs, self.starts, measure_note_counts, 0)
+        self.stream_stats = IntegerStats()
+        self.break_stats = IntegerStats()
+        self._count_runs(self.runs, 1)
+        # a breakdown that opens with a stream starts with a "(0)" break
+        self.leading_break = self._has_leading_break()
+        if self.leading_break:
+            self.break_stats.add(0)
+
+    def _append_runs(self, runs, starts, note_counts, offset):
+        for i, note_count in enumerate(note_counts):
+            is_stream = note_count >= self.threshold
+            if runs and runs[-1][0] == is_stream:
+                runs[-1][1] += 1
+            else:
+                runs.append([is_stream, 1])
+                starts.append(offset + i)
+
+    def _count_runs(self, runs, sign):
+        for is_stream, length in runs:
+            stats = self.stream_stats if is_stream else self.break_stats
+            if sign > 0:
+                stats.add(length)
+            else:
+                stats.remove(length)
+
+    def _has_leading_break(self):
+        return not self.runs or self.runs[0][0]
+
+    def update(self, measure_note_counts, start, end):
+        """
+        Re-split the runs around measures [start, end) of measure_note_counts.
+        Returns True if the breakdown changed
+        """
+        first = max(bisect_right(self.starts, start) - 2, 0)
+        last = min(bisect_right(self.starts, end - 1), len(self.runs) - 1)
+        span_start = self.starts[first]
+        span_end = self.starts[last] + self.runs[last][1]
+
+        runs, starts = [], []
+        self._append_runs(runs, starts, measure_note_counts[span_start:span_end], span_start)
+        if runs == self.runs[first:last + 1]:
+            return False
+        self._count_runs(self.runs[first:last + 1], -1)
+        self._count_runs(runs, 1)
+        self.runs[first:last + 1] = runs
+        self.starts[first:last + 1] = starts
+
+        leading_break = self._has_leading_break()
+        if leading_break != self.leading_break:
+            if leading_break:
+                self.break_stats.add(0)
+            else:
+                self.break_stats.remove(0)
+            self.leading_break = leading_break
+        return True
+
+    def breakdown(self):
+        """Same format as Stepchart._generate_stream_breakdown"""
+        breakdown = ["(0)"] if self.leading_break else []
+        for is_stream, length in self.runs:
+            breakdown.append(f"{length}" if is_stream else f"({length})")
+        return breakdown
+
+
+def analyze_measure(quantization, row_infos):
+    """
+    MeasureValues for one measure, from its rows.RowInfo list and
+    measure_quantization, counted the same way as Stepchart._analyze_measures
+    """
+    note_count = 0
+    step_count = 0
+    jump_hand_quad_counts = [0] * 6     # jumps, hands, quads, mines, holds, rolls
+    snap_counts = {}
+    arrows = []
+    freeze_slots = False
+    for info, (_, snap) in zip(row_infos, quantization):
+        if info.notes:
+            note_count += 1
+            step_count += info.notes
+            snap_counts[snap] = snap_counts.get(snap, 0) + 1
+            arrows.append(info.arrow)
+        if info.chord:
+            jump_hand_quad_counts[info.chord - 2] += 1
+        jump_hand_quad_counts[3] += info.mines
+        jump_hand_quad_counts[4] += info.holds
+        jump_hand_quad_counts[5] += info.rolls
+        freeze_slots = freeze_slots or info.freeze_slots
+    return MeasureValues(
+        note_count,
+        step_count,
+        jump_hand_quad_counts,
+        snap_counts,
+        snaps_lcm(snap_counts),
+        "".join(arrows),
+        freeze_slots,
+    )
+
+
+class IncrementalChart(object):
+    """
+    Incremental state for one difficulty of a Stepchart. Building it scans
+    the chart once, after which edit_measures only touches the edited
+    measures and the aggregates that depend on them.
+    """
+
+    def __init__(self, stepchart, difficulty):
+        self.stepchart = stepchart
+        self.difficulty = difficulty
+        self.chart = stepchart.charts[difficulty]
+        self.metadata = stepchart.metadata[difficulty]
+        if "measure_list" not in self.chart:
+            stepchart._generate_measures(difficulty)
+        if "quantization_index" not in self.chart:
+            stepchart._generate_quantization_index(difficulty)
+        measures = self.chart["measure_list"]
+        time_metadata = stepchart.in_measure_time_metadata
+
+        # every row is looked up once, and all per-measure values
+        # (and the freeze tracking) come from that RowInfo list
+        tracker = FreezeTracker(stepchart._get_timing_map())
+        measure_values = []
+        measure_freezes = []
+        for measure_number, (measure, quantization) in enumerate(zip(measures, self.chart["quantization_index"])):
+            row_infos = [row_info(subdivision) for subdivision in measure]
+            measure_values.append(analyze_measure(quantization, row_infos))
+            measure_freezes.append(track_measure_freezes(tracker, measure, measure_number, row_infos))
+
+        self.step_counts = FenwickTree([values.step_count for values in measure_values])
+        self.jump_hand_quad_counts = [
+            FenwickTree([values.jump_hand_quad_counts[i] for values in measure_values])
+            for i in range(len(JUMP_HAND_QUAD_KEYS))
+        ]
+
+        self.snap_counts = Counter()
+        self.measure_snap_counts = []
+        for values in measure_values:
+            self.measure_snap_counts.append(values.snap_counts)
+            self.snap_counts.update(values.snap_counts)
+        self.measure_snaps = [values.snap for values in measure_values]
+        self.stream_snap_counts = Counter(
+            values.snap
+            for values in measure_values
+            if values.note_count >= stepchart.stream_note_threshold
+        )
+        self.measure_freeze_slots = [values.freeze_slots for values in measure_values]
+
+        # nps is only measured for measures covered by the song's time metadata
+        self.nps_measure_count = min(len(measures), len(time_metadata))
+        self.nps = [
+            calculate_measure_nps(measures[i], time_metadata[i], note_count=measure_values[i].step_count)
+            for i in range(self.nps_measure_count)
+        ]
+        self.nps_tree = SegmentTree(self.nps)
+        self.nps_sorted = sorted(self.nps)
+        self.nps_counts = Counter(self.nps)
+
+        self.stream_runs = {"": StreamRuns(self.chart["measure_note_counts"], stepchart.stream_note_threshold)}
+        for threshold in stepchart.stream_note_thresholds:
+            self.stream_runs[f"_{threshold}"] = StreamRuns(self.chart["measure_note_counts"], threshold)
+
+        self.measure_arrows = [values.arrows for values in measure_values]
+        # tech pattern counts credited to each measure, and the
+        # TechPatternCounter state after it
+        self.tech_counts = []
+        self.tech_states = []
+        counter = TechPatternCounter()
+        for arrows in self.measure_arrows:
+            counter.totals = [0, 0, 0, 0, 0]
+            counter.add(arrows)
+            self.tech_counts.append(counter.result())
+            self.tech_states.append(counter.state())
+
+        self.chart["freeze_index"] = tracker.finish(len(measures))
+        self.measure_freeze_notes = [freeze_notes for freeze_notes, _ in measure_freezes]
+        self.measure_freeze_changes = [changes for _, changes in measure_freezes]
+        self.freeze_notes = sum(self.measure_freeze_notes)
+        self.freeze_changes = [sum(changes) for changes in zip([0, 0, 0], *self.measure_freeze_changes)]
+
+    def edit_measures(self, start, new_measures):
+        """
+        Replace measures[start:start + len(new_measures)] with new_measures
+        and update the difficulty's metadata in place.
+
+        :param start:         index of the first measure to replace
+        :param new_measures:  list of measures, each a list of rows. eg:
+                              [['0001', '1000', '0100', '0010'], ...]
+        """
+        measures = self.chart["measure_list"]
+        end = start + len(new_measures)
+        if start < 0 or end > len(measures):
+            raise IndexError(
+                f"edit of measures [{start}, {end}) is outside of {len(measures)} measures"
+            )
+        if not new_measures:
+            return
+
+        new_measures = [[row.strip() for row in measure] for measure in new_measures]
+        new_row_infos = [[row_info(subdivision) for subdivision in measure] for measure in new_measures]
+        new_values = [
+            analyze_measure(measure_quantization(len(measure)), row_infos)
+            for measure, row_infos in zip(new_measures, new_row_infos)
+        ]
+
+        # Freezes only matter to an edit that overlaps one or adds/removes one.
+        # Anything else leaves every freeze feature but freeze_jumps/hands/quads alone
+        freezes_changed = (
+            self.chart["freeze_index"].overlap_count(4 * start, 4 * end) > 0
+            or any(self.measure_freeze_slots[start:end])
+            or any(values.freeze_slots for values in new_values)
+        )
+
+        time_metadata = self.stepchart.in_measure_time_metadata
+        note_counts = self.chart["measure_note_counts"]
+        main_threshold = self.stepchart.stream_note_threshold
+
+        for offset, (measure, values) in enumerate(zip(new_measures, new_values)):
+            index = start + offset
+            measures[index] = measure
+            self.chart["quantization_index"][index] = measure_quantization(len(measure))
+            self.measure_freeze_slots[index] = values.freeze_slots
+
+            if note_counts[index] >= main_threshold:
+                self.stream_snap_counts[self.measure_snaps[index]] -= 1
+            note_counts[index] = values.note_count
+            self.measure_snaps[index] = values.snap
+            if note_counts[index] >= main_threshold:
+                self.stream_snap_counts[self.measure_snaps[index]] += 1
+
+            self.step_counts.set(index, values.step_count)
+            for tree, count in zip(self.jump_hand_quad_counts, values.jump_hand_quad_counts):
+                tree.set(index, count)
+
+            self.snap_counts.subtract(self.measure_snap_counts[index])
+            self.snap_counts.update(values.snap_counts)
+            self.measure_snap_counts[index] = values.snap_counts
+
+            if index < self.nps_measure_count:
+                self._set_nps(
+                    index, calculate_measure_nps(measure, time_metadata[index], note_count=values.step_count)
+                )
+
+            self.measure_arrows[index] = values.arrows
+
+        changed_breakdowns = [
+            suffix
+            for suffix, runs in self.stream_runs.items()
+            if runs.update(note_counts, start, end)
+        ]
+
+        self._recount_tech(start, end)
+        self._update_metadata(changed_breakdowns)
+        if freezes_changed:
+            self._retrack_freezes(start, end, new_row_infos)
+        self.stepchart._record_freeze_metadata(
+            self.difficulty, self.chart["freeze_index"], self.freeze_notes, self.freeze_changes
+        )
+
+    def _recount_tech(self, start, end):
+        """
+        Re-read tech patterns from measure start, resuming from the counter
+        state saved before it. Past the edited measures [start, end), the
+        counts only change until the state after a measure matches the saved
+        one again, which is at the latest the next jump or hand.
+        """
+        counter = TechPatternCounter()
+        counter.set_state(self.tech_states[start - 1] if start else NEW_GROUP_STATE)
+        changes = [0, 0, 0, 0, 0]
+        for index in range(start, len(self.measure_arrows)):
+            old_state = self.tech_states[index]
+            counter.totals = [0, 0, 0, 0, 0]
+            counter.add(self.measure_arrows[index])
+            counts = counter.result()
+            changes = [
+                change + new - old
+                for change, new, old in zip(changes, counts, self.tech_counts[index])
+            ]
+            self.tech_counts[index] = counts
+            self.tech_states[index] = counter.state()
+            if index >= end - 1 and counter.state() == old_state:
+                break
+        for key, change in zip(TECH_KEYS, changes):
+            self.metadata[key] += change
+
+    def _retrack_freezes(self, start, end, row_infos):
+        """
+        Re-track freezes around edited measures [start, end), and swap the
+        re-tracked freezes into the chart's FreezeIndex. row_infos are the
+        edited measures' RowInfo lists.
+
+        Tracking restarts at the measure holding the earliest head of a freeze
+        that overlaps the edit, from the freezes held there before the edit.
+        It stops at the first measure after the edit where the same freezes
+        are held as before the edit: from there on the rows are unchanged, so
+        everything else would come out the same.
+        """
+        index = self.chart["freeze_index"]
+        measures = self.chart["measure_list"]
+        window_start = min([start] + [freeze.start_measure for freeze in index.overlapping(4 * start, 4 * end)])
+
+        tracker = FreezeTracker(self.stepchart._get_timing_map())
+        for freeze in index.held_at(4 * window_start):
+            tracker.hold(freeze)
+
+        measure_number = window_start
+        while measure_number < len(measures):
+            if measure_number >= end and tracker.held == _held_state(index, measure_number):
+                break
+            measure_row_infos = row_infos[measure_number - start] if start <= measure_number < end else None
+            freeze_notes, changes = track_measure_freezes(
+                tracker, measures[measure_number], measure_number, measure_row_infos
+            )
+            self.freeze_notes += freeze_notes - self.measure_freeze_notes[measure_number]
+            self.freeze_changes = [
+                total + new - old
+                for total, new, old in zip(self.freeze_changes, changes, self.measure_freeze_changes[measure_number])
+            ]
+            self.measure_freeze_notes[measure_number] = freeze_notes
+            self.measure_freeze_changes[measure_number] = changes
+            measure_number += 1
+
+        # replace the old freezes that ended inside the re-tracked window
+        window_end = measure_number
+        if window_end == len(measures):
+            tracker.finish(len(measures))
+            window_end = len(measures) + 1
+        index.replace(index.ended_in(window_start, window_end), tracker.freezes)
+
+    def _set_nps(self, index, nps):
+        old_nps = self.nps[index]
+        self.nps[index] = nps
+        self.nps_tree.set(index, nps)
+        del self.nps_sorted[bisect_left(self.nps_sorted, old_nps)]
+        insort(self.nps_sorted, nps)
+        self.nps_counts[old_nps] -= 1
+        if not self.nps_counts[old_nps]:
+            del self.nps_counts[old_nps]
+        self.nps_counts[nps] += 1
+
+    def _nps_mode(self):
+        """Most common nps, ties broken by first appearance like statistics.mode"""
+        top_count = max(self.nps_counts.values())
+        candidates = {nps for nps, count in self.nps_counts.items() if count == top_count}
+        if len(candidates) == 1:
+            return candidates.pop()
+        return next(nps for nps in self.nps if nps in candidates)
+
+    def _update_metadata(self, changed_breakdowns):
+        metadata = self.metadata
+
+        step_count = self.step_counts.total()
+        metadata["step_count"] = step_count
+        metadata["song_nps"] = float(step_count) / float(self.stepchart._calculate_song_length())
+        for key, tree in zip(JUMP_HAND_QUAD_KEYS, self.jump_hand_quad_counts):
+            metadata[key] = tree.total()
+
+        for snap in SNAP_LEVELS:
+            metadata[f"snap_{snap}_count"] = self.snap_counts.get(snap, 0)
+        metadata["snap_other_count"] = sum(
+            count for snap, count in self.snap_counts.items() if snap not in SNAP_LEVELS
+        )
+
+        if self.nps:
+            count = len(self.nps)
+            total = self.nps_tree.total()
+            metadata["nps_per_measure_max"] = self.nps_tree.max()
+            metadata["nps_per_measure_avg"] = total / count
+            metadata["nps_per_measure_median"] = median(self.nps_sorted)
+            if count >= 2:
+                variance = (self.nps_tree.total_squares() - total * total / count) / (count - 1)
+                metadata["nps_per_measure_std"] = max(variance, 0.0) ** 0.5
+            metadata["nps_per_measure_mode"] = self._nps_mode()
+
+        for suffix in changed_breakdowns:
+            runs = self.stream_runs[suffix]
+            for key in STREAM_STAT_KEYS:
+                metadata.pop(f"{key}{suffix}", None)
+            metadata[f"stream_total{suffix}"] = runs.stream_stats.total
+            metadata[f"breakdown{suffix}"] = runs.breakdown()
+            self.stepchart._record_stream_stats(self.difficulty, runs.stream_stats, runs.break_stats, suffix)
+
+        metadata.pop("stream_snap", None)
+        stream_snap_counts = [(snap, count) for snap, count in self.stream_snap_counts.items() if count]
+        if stream_snap_counts:
+            metadata["stream_snap"] = max(stream_snap_counts, key=lambda x: (x[1], -x[0]))[0]
+
+
+def _held_state(freeze_index, measure_number):
+    """FreezeTracker.held for the start of a measure, from a FreezeIndex"""
+    return {
+        freeze.column: (freeze.kind, freeze.start_measure, freeze.start_row, freeze.start_beat)
+        for freeze in freeze_index.held_at(4 * measure_number)
+    }
+
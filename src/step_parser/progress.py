@@ -0,0 +1,188 @@
+"""
+Progress reporting for batch_analysis.
+
+ProgressReporter tracks files, notes and bytes processed, errors by
+category and the file currently being analyzed. It prints a status line
+for people, and can write the same numbers as JSON lines for programs:
+
+    {"event": "start", "time": 1700000000.0, "files_total": 4000}
+    {"event": "progress", "files_done": 1200, "files_per_sec": 35.1, ...}
+    {"event": "complete", "files_done": 4000, ...}
+
+A run that stops on an exception ends with an "aborted" event instead of
+"complete", carrying the exception as "error".
+
+Reports are rate limited, so recording a file is only a few additions
+and a clock read. While a single file takes longer than the JSON
+interval, a background thread keeps emitting "heartbeat" events, so a
+stalled run shows up as a growing "seconds_since_last_file".
+"""
+import json
+import sys
+import threading
+import time
+
+
+class ProgressReporter(object):
+
+    def __init__(
+        self,
+        files_total=None,
+        json_file=None,
+        human=True,
+        human_interval=5.0,
+        json_interval=1.0,
+        out=None,
+    ):
+        """
+        :param files_total:     number of files expected, for ETA. None if unknown
+        :param json_file:       path or file object to write JSON line events to
+        :param human:           print status lines
+        :param human_interval:  min seconds between status lines
+        :param json_interval:   min seconds between progress events
+        :param out:             stream for status lines [default=sys.stdout]
+        """
+        self.files_total = files_total
+        self.human = human
+        self.human_interval = human_interval
+        self.json_interval = json_interval
+        self.out = out or sys.stdout
+
+        self._owns_json_file = isinstance(json_file, str)
+        self.json_file = open(json_file, "w") if self._owns_json_file else json_file
+
+        self.files_done = 0
+        self.notes_done = 0
+        self.bytes_done = 0
+        self.errors = {}            # category: count
+        self.current_file = None
+
+        self.start_time = time.monotonic()
+        self.last_file_time = self.start_time
+        self._next_human_report = self.start_time + human_interval
+        self._next_json_report = self.start_time + json_interval
+
+        self._emit_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._emit({"event": "start", "time": time.time(), "files_total": files_total})
+        if self.json_file is not None:
+            self._heartbeat = threading.Thread(target=self._heartbeat_loop, daemon=True)
+            self._heartbeat.start()
+
+    def start_file(self, name):
+        self.current_file = name
+
+    def finish_file(self, notes=0, size=0, error_category=None):
+        """
+        Record a processed file.
+
+        :param notes:           notes found in the file (all charts)
+        :param size:            file size in bytes
+        :param error_category:  eg. "UnicodeDecodeError", None on success
+        """
+        self.files_done += 1
+        self.notes_done += notes
+        self.bytes_done += size
+        if error_category is not None:
+            self.errors[error_category] = self.errors.get(error_category, 0) + 1
+
+        now = time.monotonic()
+        self.last_file_time = now
+        if now >= self._next_json_report:
+            self._next_json_report = now + self.json_interval
+            self._emit(self.snapshot(now, "progress"))
+        if now >= self._next_human_report:
+            self._next_human_report = now + self.human_interval
+            self._print_status(self.snapshot(now, "progress"))
+
+    def close(self, error=None):
+        """
+        Report final totals, and close the JSON file if we opened it
+
+        :param error:   the exception that stopped the run early, if any.
+                        Reported as an "aborted" event instead of "complete"
+        """
+        self._closed.set()
+        if error is None:
+            self.current_file = None
+            snapshot = self.snapshot(time.monotonic(), "complete")
+        else:
+            # current_file is left as the file the run stopped on
+            snapshot = self.snapshot(time.monotonic(), "aborted")
+            snapshot["error"] = f"{type(error).__name__}: {error}"
+        self._emit(snapshot)
+        self._print_status(snapshot)
+        if self._owns_json_file:
+            self.json_file.close()
+
+    def snapshot(self, now=None, event="progress"):
+        """Current counters and rates as a dict"""
+        if now is None:
+            now = time.monotonic()
+        elapsed = now - self.start_time
+        files_per_sec = self.files_done / elapsed if elapsed > 0 else 0.0
+        eta_seconds = None
+        if self.files_total is not None and files_per_sec > 0:
+            eta_seconds = max(self.files_total - self.files_done, 0) / files_per_sec
+
+        return {
+            "event": event,
+            "time": time.time(),
+            "elapsed_seconds": elapsed,
+            "files_done": self.files_done,
+            "files_total": self.files_total,
+            "files_per_sec": files_per_sec,
+            "notes_per_sec": self.notes_done / elapsed if elapsed > 0 else 0.0,
+            "bytes_per_sec": self.bytes_done / elapsed if elapsed > 0 else 0.0,
+            "eta_seconds": eta_seconds,
+            "seconds_since_last_file": now - self.last_file_time,
+            "errors": dict(self.errors),
+            "error_count": sum(self.errors.values()),
+            "current_file": self.current_file,
+        }
+
+    def _heartbeat_loop(self):
+        while not self._closed.wait(self.json_interval):
+            now = time.monotonic()
+            if now - self.last_file_time >= self.json_interval:
+                self._emit(self.snapshot(now, "heartbeat"))
+
+    def _emit(self, event):
+        if self.json_file is None:
+            return
+        with self._emit_lock:
+            if event["event"] == "heartbeat" and self._closed.is_set():
+                return
+            self.json_file.write(json.dumps(event) + "\n")
+            self.json_file.flush()
+
+    def _print_status(self, snapshot):
+        if not self.human:
+            return
+        if snapshot["files_total"] is not None:
+            files = f"{snapshot['files_done']}/{snapshot['files_total']} files"
+        else:
+            files = f"{snapshot['files_done']} files"
+        status = (
+            f"{files}  "
+            f"{snapshot['files_per_sec']:.1f} files/s  "
+            f"{snapshot['notes_per_sec']:.0f} notes/s  "
+            f"{snapshot['bytes_per_sec'] / 1e6:.2f} MB/s"
+        )
+        if snapshot["eta_seconds"] is not None and snapshot["event"] == "progress":
+            status += f"  ETA {format_seconds(snapshot['eta_seconds'])}"
+        if snapshot["errors"]:
+            errors = ", ".join(f"{category}: {count}" for category, count in snapshot["errors"].items())
+            status += f"  errors {snapshot['error_count']} ({errors})"
+        if snapshot["event"] == "progress" and snapshot["current_file"]:
+            status += f"  | {snapshot['current_file']}"
+        if snapshot["event"] == "aborted":
+            status += f"  ABORTED ({snapshot['error']})"
+        print(status, file=self.out, flush=True)
+
+
+def format_seconds(seconds):
+    """3725.2 -> '1:02:05'"""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
@@ -0,0 +1,64 @@
+from fractions import Fraction
+from functools import lru_cache
+from math import gcd
+
+
+# Snap levels reported as features, in notes per measure (4th, 8th, 12th, ...)
+SNAP_LEVELS = [4, 8, 12, 16, 24, 32, 48, 64, 192]
+
+
+def row_snap(row_index, rows_in_measure):
+    """
+    Snap level of a row, in notes per measure. eg. in a 16 row measure:
+        row 0 -> 4 (4th), row 2 -> 8 (8th), row 1 -> 16 (16th)
+
+    The row sits at fraction row_index / rows_in_measure of the measure.
+    Reduced, its denominator is the coarsest subdivision the row lands on,
+    and since a measure has 4 beats every snap is a multiple of 4.
+    """
+    denominator = rows_in_measure // gcd(row_index, rows_in_measure)
+    return denominator * 4 // gcd(denominator, 4)
+
+
+@lru_cache(maxsize=None)
+def measure_quantization(rows_in_measure):
+    """
+    Quantization of every row in a measure with `rows_in_measure` rows.
+    Measures mostly come in a handful of lengths (4, 8, 16, 24, ...), so this
+    is cached and each distinct length is only computed once.
+
+    :return:
+        tuple of (beat, snap) per row, where beat is a Fraction in [0, 4). eg:
+        for 8 rows: ((0, 4), (1/2, 8), (1, 4), (3/2, 8), ...)
+    """
+    return tuple(
+        (Fraction(4 * row_index, rows_in_measure), row_snap(row_index, rows_in_measure))
+        for row_index in range(rows_in_measure)
+    )
+
+
+def generate_quantization_index(measure_list):
+    """
+    :param measure_list:
+        List of measures, with list of subdivisions of notes. eg:
+        [['0001', '1000', '0100', '0010'], ['0100', '0000', '1001', '0000'], ...]
+    :return:
+        List of measure_quantization() results, one per measure. The absolute
+        beat of a row is 4 * measure_number + beat
+    """
+    return [measure_quantization(len(measure)) for measure in measure_list]
+
+
+def snaps_lcm(snaps):
+    """
+    Finest snap that all of `snaps` land on, or None if there are none.
+    For the snaps of a measure's notes, it's the snap needed to write the
+    measure. eg. a full 16th stream measure -> 16, a 24th stream measure -> 24
+    """
+    measure_snap_level = None
+    for snap in set(snaps):
+        measure_snap_level = snap if measure_snap_level is None else (
+            measure_snap_level * snap // gcd(measure_snap_level, snap)
+        )
+    return measure_snap_level
+
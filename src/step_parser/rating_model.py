@@ -0,0 +1,504 @@
+"""
+Difficulty rating model.
+
+RatingModel is a ridge regression (linear model with an L2 penalty on
+standardized features) from batch_analysis features to a chart's rating.
+
+Fitting reads the features once, in batches, and keeps only the sums and
+co-moments least squares needs, so a feature store bigger than memory can
+be fit without loading it. Scoring works a batch of rows at a time too
+(see predict_columns): every feature column the model uses is parsed and
+added into the predictions with one map over the batch.
+
+When NumPy is installed (pip install "sm_tools[numpy]"), a fitting batch's
+co-moments are one matrix product, and a scoring batch is parsed as one
+array and scored with a single matrix product. Results agree with the pure
+Python ones to float rounding.
+
+    model = RatingModel.fit_csv("step_parser_output.csv")
+    model.save("rating_model.json")
+    RatingModel.load("rating_model.json").score_csv("new_songs.csv", "scores.csv")
+
+Missing values (empty csv fields, None, nan) count as 0, like a chart
+without streams having no stream stats.
+"""
+import csv
+import json
+import math
+from itertools import compress, islice
+from operator import add, itemgetter, mul
+
+from step_parser.constants import CSV_ENCODING
+
+
+MODEL_FORMAT = "step_parser.rating_model"
+MODEL_VERSION = 1
+TARGET_COLUMN = "rating"
+PREDICTION_COLUMN = "predicted_rating"
+# identifiers and text, never features
+NON_FEATURE_COLUMNS = {"", "rating", "difficulty", "title", "artist", PREDICTION_COLUMN}
+# copied from the features to the score_csv output
+SCORE_ID_COLUMNS = ["", "title", "artist", "difficulty", "rating"]
+BATCH_SIZE = 4096
+
+_numpy = None
+
+
+def import_numpy():
+    """numpy, or None if it isn't installed. Only imported once scoring needs it"""
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+        _numpy = numpy
+    return _numpy or None
+
+
+def to_number(value):
+    """int, float or numeric string -> float. None for anything else, and for nan"""
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if math.isnan(number) else number
+
+
+def parse_column(values):
+    """A column of raw values -> floats, with missing values as 0.0"""
+    try:
+        numbers = list(map(float, values))
+    except (TypeError, ValueError):
+        try:
+            # usually just empty csv fields / None
+            numbers = [float(value) if value else 0.0 for value in values]
+        except (TypeError, ValueError):
+            return [to_number(value) or 0.0 for value in values]
+    if any(map(math.isnan, numbers)):
+        numbers = [0.0 if math.isnan(number) else number for number in numbers]
+    return numbers
+
+
+def cells_getter(indexes):
+    """itemgetter(*indexes), except it always returns a tuple, even for 0 or 1 indexes"""
+    if len(indexes) == 1:
+        index = indexes[0]
+        return lambda row: (row[index],)
+    if not indexes:
+        return lambda row: ()
+    return itemgetter(*indexes)
+
+
+def feature_columns(columns):
+    """Columns of a batch_analysis record/csv that can be model features"""
+    return [
+        column
+        for column in columns
+        if column not in NON_FEATURE_COLUMNS and not column.startswith("breakdown")
+    ]
+
+
+def record_features(records):
+    """Feature columns of a list of records: keys with a number in any record, in first seen order"""
+    numeric = {}
+    for record in records:
+        for column, value in record.items():
+            if not numeric.get(column):
+                numeric[column] = to_number(value) is not None
+    return [column for column in feature_columns(numeric) if numeric[column]]
+
+
+def iter_csv_batches(f, batch_size=BATCH_SIZE):
+    """
+    Read a csv in batches of rows.
+
+    :param f:   open csv file
+    :return:    (header, generator of lists of rows)
+    """
+    reader = csv.reader(f)
+    header = next(reader, [])
+
+    def batches():
+        while True:
+            batch = list(islice(reader, batch_size))
+            if not batch:
+                return
+            yield batch
+
+    return header, batches()
+
+
+class RegressionMoments(object):
+    """
+    Sums for least squares, accumulated a batch of columns at a time:
+    count, sum(x), sum(x x^T), sum(x y), sum(y), sum(y^2). Values are
+    shifted by the first row seen, so centering them afterwards doesn't
+    cancel away precision.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.count = 0
+        self.x_shift = None
+        self.y_shift = 0.0
+        self.x_sums = [0.0] * size
+        self.xx_sums = [[0.0] * (size - i) for i in range(size)]   # upper triangle, row i starts at column i
+        self.xy_sums = [0.0] * size
+        self.y_sum = 0.0
+        self.yy_sum = 0.0
+
+    def add_batch(self, x_columns, y):
+        """
+        :param x_columns:   one list of floats per feature, all len(y) long
+        :param y:           list of targets
+        """
+        if not y:
+            return
+        if self.x_shift is None:
+            self.x_shift = [column[0] for column in x_columns]
+            self.y_shift = y[0]
+        np = import_numpy()
+        if np is not None:
+            return self._add_batch_numpy(np, x_columns, y)
+        x_columns = [
+            [value - shift for value in column] if shift else column
+            for column, shift in zip(x_columns, self.x_shift)
+        ]
+        y = [value - self.y_shift for value in y] if self.y_shift else y
+
+        self.count += len(y)
+        self.y_sum += sum(y)
+        self.yy_sum += sum(map(mul, y, y))
+        for i, column in enumerate(x_columns):
+            self.x_sums[i] += sum(column)
+            self.xy_sums[i] += sum(map(mul, column, y))
+            xx_sums = self.xx_sums[i]
+            for j, other in enumerate(x_columns[i:]):
+                xx_sums[j] += sum(map(mul, column, other))
+
+    def _add_batch_numpy(self, np, x_columns, y):
+        """add_batch with the co-moments as one matrix product"""
+        x = np.array(x_columns, dtype=float).reshape(self.size, len(y)) - np.array(self.x_shift)[:, None]
+        y = np.array(y, dtype=float) - self.y_shift
+        x_sums = x.sum(axis=1).tolist()
+        xy_sums = (x @ y).tolist()
+        xx_sums = (x @ x.T).tolist()
+
+        self.count += len(y)
+        self.y_sum += float(y.sum())
+        self.yy_sum += float(y @ y)
+        for i in range(self.size):
+            self.x_sums[i] += x_sums[i]
+            self.xy_sums[i] += xy_sums[i]
+            self.xx_sums[i] = list(map(add, self.xx_sums[i], xx_sums[i][i:]))
+
+    def centered(self):
+        """
+        :return: (x means, covariance matrix, x-y covariances, y mean, y variance),
+            all as sums of centered products (not divided by count)
+        """
+        count = self.count
+        x_means = [shift + total / count for shift, total in zip(self.x_shift, self.x_sums)]
+        y_mean = self.y_shift + self.y_sum / count
+        xx = [[0.0] * self.size for _ in range(self.size)]
+        for i in range(self.size):
+            for j in range(i, self.size):
+                xx[i][j] = xx[j][i] = self.xx_sums[i][j - i] - self.x_sums[i] * self.x_sums[j] / count
+        xy = [total - x_total * self.y_sum / count for total, x_total in zip(self.xy_sums, self.x_sums)]
+        yy = self.yy_sum - self.y_sum * self.y_sum / count
+        return x_means, xx, xy, y_mean, yy
+
+
+def solve_cholesky(matrix, vector):
+    """Solve matrix @ x = vector for a symmetric positive definite matrix"""
+    size = len(vector)
+    lower = [[0.0] * size for _ in range(size)]
+    for i in range(size):
+        for j in range(i + 1):
+            total = matrix[i][j] - sum(map(mul, lower[i][:j], lower[j][:j]))
+            if i == j:
+                if not total > 0:
+                    raise ValueError(
+                        f"matrix is not positive definite (pivot {i} is {total}), "
+                        "features are collinear: fit with a larger alpha"
+                    )
+                lower[i][i] = math.sqrt(total)
+            else:
+                lower[i][j] = total / lower[j][j]
+
+    forward = [0.0] * size
+    for i in range(size):
+        forward[i] = (vector[i] - sum(map(mul, lower[i][:i], forward[:i]))) / lower[i][i]
+    solution = [0.0] * size
+    for i in reversed(range(size)):
+        total = sum(lower[j][i] * solution[j] for j in range(i + 1, size))
+        solution[i] = (forward[i] - total) / lower[i][i]
+    return solution
+
+
+class RatingModel(object):
+    """
+    rating ~= intercept + sum(coefficient * feature)
+
+    Coefficients are stored in raw feature units, so scoring is a single
+    dot product per chart.
+    """
+
+    def __init__(self, features, coefficients, intercept, alpha=None, training=None):
+        """
+        :param features:        feature column names
+        :param coefficients:    one per feature
+        :param intercept:       prediction when every feature is 0
+        :param alpha:           ridge penalty the model was fit with
+        :param training:        dict of stats about the fit (count, rmse, r2, ...)
+        """
+        self.features = list(features)
+        self.coefficients = list(coefficients)
+        self.intercept = intercept
+        self.alpha = alpha
+        self.training = training or {}
+
+    @classmethod
+    def fit(cls, records, features=None, alpha=1.0, batch_size=BATCH_SIZE):
+        """
+        Fit on batch_analysis records (dicts, eg. batch_analysis(..., as_dataframe=False)).
+
+        :param records:     iterable of dicts with a "rating" key
+        :param features:
+            feature names [default=every key with a number in any record,
+            which means holding all the records in memory to look]
+        :param alpha:       ridge penalty on standardized coefficients, greater than 0
+        """
+        if features is None:
+            # records leave out keys they have no value for (eg. stream stats of
+            # a chart without streams), so no single record has every feature
+            records = list(records)
+            features = record_features(records)
+        records = iter(records)
+        first = next(records, None)
+        if first is None:
+            raise ValueError("no records to fit on")
+
+        def batches():
+            batch = [first] + list(islice(records, batch_size - 1))
+            while batch:
+                yield (
+                    [[record.get(feature) for record in batch] for feature in features],
+                    [record.get(TARGET_COLUMN) for record in batch],
+                )
+                batch = list(islice(records, batch_size))
+
+        return cls._fit_batches(features, batches(), alpha)
+
+    @classmethod
+    def fit_csv(cls, csv_file, features=None, alpha=1.0, batch_size=BATCH_SIZE):
+        """
+        Fit on a batch_analysis csv, reading it once, batch_size rows at a time.
+
+        :param features:    feature names [default=every column except ids and text]
+        """
+        with open(csv_file, newline="", encoding=CSV_ENCODING) as f:
+            header, batches = iter_csv_batches(f, batch_size)
+            if TARGET_COLUMN not in header:
+                raise ValueError(f"{csv_file} has no {TARGET_COLUMN} column")
+            if features is None:
+                features = feature_columns(header)
+            missing = [feature for feature in features if feature not in header]
+            if missing:
+                raise ValueError(f"{csv_file} is missing features: {', '.join(missing)}")
+            indexes = [header.index(feature) for feature in features]
+            target_index = header.index(TARGET_COLUMN)
+
+            def column_batches():
+                for batch in batches:
+                    columns = list(zip(*batch))
+                    yield [columns[i] for i in indexes], columns[target_index]
+
+            return cls._fit_batches(features, column_batches(), alpha)
+
+    @classmethod
+    def _fit_batches(cls, features, batches, alpha):
+        # batch_analysis features always have collinear columns, so it takes
+        # a penalty to make the least squares matrix invertible
+        if not alpha > 0:
+            raise ValueError(f"alpha must be greater than 0, got {alpha}")
+        moments = RegressionMoments(len(features))
+        for x_columns, y in batches:
+            # charts without a usable rating can't be trained on
+            y = [to_number(value) for value in y]
+            rated = [value is not None for value in y]
+            if not all(rated):
+                x_columns = [list(compress(column, rated)) for column in x_columns]
+                y = list(compress(y, rated))
+            moments.add_batch([parse_column(column) for column in x_columns], y)
+        if moments.count < 2:
+            raise ValueError(f"need at least 2 rated charts to fit, got {moments.count}")
+
+        x_means, xx, xy, y_mean, yy = moments.centered()
+        # standardize, and leave out features that never change
+        scales = [math.sqrt(max(xx[i][i], 0.0) / moments.count) for i in range(len(features))]
+        used = [i for i, scale in enumerate(scales) if scale > 0]
+        matrix = [
+            [xx[i][j] / (scales[i] * scales[j]) + (alpha if i == j else 0.0) for j in used]
+            for i in used
+        ]
+        standardized = solve_cholesky(matrix, [xy[i] / scales[i] for i in used])
+
+        coefficients = [0.0] * len(features)
+        for i, coefficient in zip(used, standardized):
+            coefficients[i] = coefficient / scales[i]
+        intercept = y_mean - sum(map(mul, coefficients, x_means))
+
+        # squared error from the moments: yy - 2 b.xy + b.XX.b
+        error = yy - 2 * sum(map(mul, coefficients, xy)) + sum(
+            coefficients[i] * sum(map(mul, xx[i], coefficients))
+            for i in used
+        )
+        error = max(error, 0.0)
+        training = {
+            "count": moments.count,
+            "rating_mean": y_mean,
+            "rmse": math.sqrt(error / moments.count),
+            "r2": 1 - error / yy if yy > 0 else None,
+        }
+        return cls(features, coefficients, intercept, alpha, training)
+
+    def predict(self, record):
+        """Predicted rating of one record (dict)"""
+        return self.intercept + sum(
+            coefficient * (to_number(record.get(feature)) or 0.0)
+            for feature, coefficient in zip(self.features, self.coefficients)
+            if coefficient
+        )
+
+    def predict_columns(self, columns, count):
+        """
+        Predicted ratings of a batch of charts.
+
+        :param columns:     {feature: list of raw values}, missing features count as 0
+        :param count:       number of charts in the batch
+        """
+        used = [
+            (feature, coefficient)
+            for feature, coefficient in zip(self.features, self.coefficients)
+            if coefficient and feature in columns
+        ]
+        np = import_numpy()
+        if np is not None and used:
+            return self._predict_numpy(np, [columns[feature] for feature, _ in used], [c for _, c in used], count)
+
+        predictions = [self.intercept] * count
+        for feature, coefficient in used:
+            values = parse_column(columns[feature])
+            predictions = list(map(add, predictions, map(coefficient.__mul__, values)))
+        return predictions
+
+    def _predict_numpy(self, np, columns, coefficients, count):
+        """predict_columns as one matrix product of the parsed columns"""
+        values = np.empty((len(columns), count))
+        for row, column in zip(values, columns):
+            if "" in column:
+                # empty csv fields
+                row[:] = parse_column(column)
+                continue
+            try:
+                # NumPy parses numeric strings itself, and None becomes nan
+                row[:] = column
+            except (TypeError, ValueError):
+                row[:] = parse_column(column)
+        values[np.isnan(values)] = 0.0
+        return (self.intercept + np.array(coefficients) @ values).tolist()
+
+    def predict_records(self, records):
+        """Predicted ratings of a list of records (dicts)"""
+        records = list(records)
+        columns = {feature: [record.get(feature) for record in records] for feature in self.features}
+        return self.predict_columns(columns, len(records))
+
+    def score_csv(self, csv_file, output_file, batch_size=BATCH_SIZE):
+        """
+        Score every row of a batch_analysis csv, batch_size rows at a time.
+        The output has the chart's identifying columns (index, title, artist,
+        difficulty, rating) and predicted_rating. Raises ValueError if the
+        csv lacks any feature the model uses.
+
+        :return: number of charts scored
+        """
+        with open(csv_file, newline="", encoding=CSV_ENCODING) as features_file:
+            header, batches = iter_csv_batches(features_file, batch_size)
+            # scoring them as 0 would quietly skew every prediction
+            missing = [feature for feature in self.features if feature not in header]
+            if missing:
+                raise ValueError(f"{csv_file} is missing model features: {', '.join(missing)}")
+            return self._score_batches(header, batches, output_file)
+
+    def _score_batches(self, header, batches, output_file):
+        """
+        Each batch goes through predict_columns, with only the columns of
+        features the model uses pulled out of it. The id columns are copied
+        over row by row, without transposing the batch.
+        """
+        indexes = {column: i for i, column in enumerate(header)}
+        id_columns = [column for column in SCORE_ID_COLUMNS if column in indexes]
+        used_features = [
+            feature
+            for feature, coefficient in zip(self.features, self.coefficients)
+            if coefficient
+        ]
+        id_cells = cells_getter([indexes[column] for column in id_columns])
+
+        scored = 0
+        with open(output_file, "w", newline="", encoding=CSV_ENCODING) as f:
+            writer = csv.writer(f)
+            writer.writerow(id_columns + [PREDICTION_COLUMN])
+            for batch in batches:
+                predictions = self.predict_columns(
+                    {feature: list(map(itemgetter(indexes[feature]), batch)) for feature in used_features},
+                    len(batch),
+                )
+                # (prediction,) tuples from zip, appended to each row's ids
+                writer.writerows(map(add, map(id_cells, batch), zip(predictions)))
+                scored += len(batch)
+        return scored
+
+    def to_dict(self):
+        return {
+            "format": MODEL_FORMAT,
+            "version": MODEL_VERSION,
+            "target": TARGET_COLUMN,
+            "intercept": self.intercept,
+            "alpha": self.alpha,
+            "training": self.training,
+            # only features the model uses, as {name: coefficient}
+            "coefficients": {
+                feature: coefficient
+                for feature, coefficient in zip(self.features, self.coefficients)
+                if coefficient
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        if data.get("format") != MODEL_FORMAT:
+            raise ValueError("not a step_parser rating model")
+        if data["version"] > MODEL_VERSION:
+            raise ValueError(f"rating model version {data['version']} is newer than this step_parser")
+        return cls(
+            list(data["coefficients"]),
+            list(data["coefficients"].values()),
+            data["intercept"],
+            data.get("alpha"),
+            data.get("training"),
+        )
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
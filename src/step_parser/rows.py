@@ -0,0 +1,65 @@
+"""
+Row lookup table.
+
+A dance-single row is 4 slots from a small alphabet (0 1 2 3 4 M ...), so
+a whole library only has a few thousand distinct rows, seen millions of
+times. row_info works out everything the detectors need to know about a
+row once, and hands back the same RowInfo for every later copy of it.
+
+    >>> row_info("1002")
+    RowInfo(notes=2, mines=0, holds=1, rolls=0, hold_ends=0, arrow='J', chord=2, freeze_slots=True)
+"""
+from collections import namedtuple
+
+from step_parser.constants import NOTE_TYPES
+
+
+ARROW_DIRECTIONS = "LDUR"
+FREEZE_SLOTS = ("2", "3", "4")
+
+RowInfo = namedtuple("RowInfo", [
+    "notes",        # slots that need stepping on: 1, 2 (hold head), 4 (roll head)
+    "mines",        # the counts below are of the 4 dance-single columns
+    "holds",
+    "rolls",
+    "hold_ends",    # 3s, ending a hold or roll
+    "arrow",        # generate_arrow_list symbol: L/D/U/R for one note, J for 2, H for 3+, "" for none
+    "chord",        # notes in the row if it's a jump/hand/quad (2/3/4), else 0
+    "freeze_slots",  # has a 2, 3 or 4, so it can start or end a freeze
+])
+
+# row string: RowInfo
+ROW_TABLE = {}
+
+
+def row_info(row):
+    """RowInfo for a row of a chart, eg. "1002". Computed on first sight, then looked up"""
+    return ROW_TABLE.get(row) or _add_row(row)
+
+
+def _add_row(row):
+    notes = sum(1 for slot in row if slot in NOTE_TYPES)
+    if notes == 1:
+        arrow = ARROW_DIRECTIONS[next(i for i, slot in enumerate(row) if slot in NOTE_TYPES)]
+    elif notes == 2:
+        arrow = "J"
+    elif notes >= 3:
+        arrow = "H"
+    else:
+        arrow = ""
+
+    # indexing each possible step per row, like detect_jumps_hands_quads always has
+    columns = [row[i].lower() for i in range(0, 4)]
+    column_notes = sum(1 for slot in columns if slot in NOTE_TYPES)
+    info = RowInfo(
+        notes=notes,
+        mines=columns.count("m"),
+        holds=columns.count("2"),
+        rolls=columns.count("4"),
+        hold_ends=columns.count("3"),
+        arrow=arrow,
+        chord=column_notes if column_notes >= 2 else 0,
+        freeze_slots=any(slot in row for slot in FREEZE_SLOTS),
+    )
+    ROW_TABLE[row] = info
+    return info
@@ -1,7 +1,15 @@
-from step_parser.constants import NOTE_TYPES
+from collections import Counter
+from itertools import accumulate
 
+from step_parser.rows import row_info
 
-ARROW_DIRECTIONS = "LDUR"
+
+# n-gram features encode generate_arrow_list output as one small int per
+# arrow: L=0 D=1 U=2 R=3 J=4 H=5
+NGRAM_SYMBOLS = "LDURJH"
+NGRAM_ENCODING = bytes.maketrans(NGRAM_SYMBOLS.encode(), bytes(range(len(NGRAM_SYMBOLS))))
+# Mirroring swaps left and right, so eg. "LDR" and "RDL" are one pattern
+NGRAM_MIRROR = bytes.maketrans(bytes([0, 3]), bytes([3, 0]))
 
 
 def generate_arrow_list(measure_list):
@@ -15,23 +23,11 @@ def generate_arrow_list(measure_list):
     J = Jump (direction not specified)
     H = Hand/Quad (direction not specified)
     """
-    arrow_list = []
-    current_arrow = 0
-    for measure in measure_list:
-        for subdivision in measure:
-            arrow_count = 0
-            for slot in subdivision:
-                if slot in NOTE_TYPES:
-                    current_arrow = slot
-                    arrow_count += 1
-            if arrow_count == 1:
-                direction = ARROW_DIRECTIONS[subdivision.index(current_arrow)]
-                arrow_list.append(direction)
-            elif arrow_count == 2:
-                arrow_list.append("J")
-            elif arrow_count >= 3:
-                arrow_list.append("H")
-    return "".join(arrow_list)
+    return "".join(
+        row_info(subdivision).arrow
+        for measure in measure_list
+        for subdivision in measure
+    )
 
 
 def detect_tech_patterns(measure_list, invalid_crossover_threshold=9):
@@ -51,7 +47,17 @@ def detect_tech_patterns(measure_list, invalid_crossover_threshold=9):
     Crossover Footswitches also count as both crossovers and footswitches
     """
     arrow_list = generate_arrow_list(measure_list)
+    return count_tech_patterns(arrow_list, invalid_crossover_threshold)
 
+
+def count_tech_patterns(arrow_list, invalid_crossover_threshold=9):
+    """
+    detect_tech_patterns for an arrow string from generate_arrow_list.
+
+    Jumps and hands reset foot positioning, so every run of arrows between
+    them is counted independently, and counts for a string are the sum of
+    the counts of its J/H separated pieces.
+    """
     crossovers = 0
     footswitches = 0
     jacks = 0
@@ -149,11 +155,134 @@ def detect_tech_patterns(measure_list, invalid_crossover_threshold=9):
     )
 
 
+# TechPatternCounter state between two arrows: how far it has got through
+# the arrow group being read (see count_tech_patterns)
+NEW_GROUP_STATE = (
+    None,               # active foot, True = right. None until the group's first L/R
+    None,               # previous arrow
+    False,              # crossed over
+    False,              # in footswitch
+    False,              # in jack
+    0,                  # crossed over length
+    0,                  # group length, counted up to 3
+    False,              # group has an L
+    False,              # group has an R
+    (0, 0, 0, 0, 0),    # counts held back until the group has 3+ arrows and both an L and
+                        # an R, None once it does
+)
+
+
+class TechPatternCounter(object):
+    """
+    count_tech_patterns for an arrow string that arrives in pieces, eg. one
+    measure at a time, read one arrow at a time.
+
+    count_tech_patterns picks the starting foot of a group from its first L
+    or R arrow, and nothing before that arrow depends on the foot, so the
+    foot is simply set when that arrow arrives. Counts of a group are held
+    back until it qualifies for counting, and dropped if it never does.
+
+    The whole state between arrows is state() (a tuple, see NEW_GROUP_STATE),
+    so counting can be resumed from any point with set_state().
+    """
+
+    def __init__(self, invalid_crossover_threshold=9):
+        self.invalid_crossover_threshold = invalid_crossover_threshold
+        self.totals = [0, 0, 0, 0, 0]
+        self._state = NEW_GROUP_STATE
+
+    def state(self):
+        return self._state
+
+    def set_state(self, state):
+        self._state = state
+
+    def add(self, arrows):
+        (
+            active_foot, previous_arrow, crossed_over, in_footswitch, in_jack,
+            crossed_over_length, group_length, has_left, has_right, held_back,
+        ) = self._state
+        totals = self.totals
+        counts = totals if held_back is None else list(held_back)
+        threshold = self.invalid_crossover_threshold
+
+        for arrow in arrows:
+            if arrow == "J" or arrow == "H":
+                # jumps and hands end the group, and reset foot positioning
+                (
+                    active_foot, previous_arrow, crossed_over, in_footswitch, in_jack,
+                    crossed_over_length, group_length, has_left, has_right, held_back,
+                ) = NEW_GROUP_STATE
+                counts = list(held_back)
+                continue
+
+            # FS/Jack detection
+            if arrow == previous_arrow:
+                if not in_footswitch:
+                    in_footswitch = True
+                else:
+                    in_jack = True
+            elif in_jack:
+                counts[3] += 1
+                in_footswitch = False
+                in_jack = False
+            elif in_footswitch:
+                counts[1] += 1
+                in_footswitch = False
+                in_jack = False
+
+            if active_foot is None and (arrow == "L" or arrow == "R"):
+                active_foot = arrow == "R"
+
+            # Crossover detection
+            if active_foot is not None:
+                if (arrow == "L" and active_foot) or (arrow == "R" and not active_foot):
+                    crossed_over = True
+
+                if crossed_over and ((arrow == "L" and not active_foot) or (arrow == "R" and active_foot)):
+                    counts[0] += 1
+                    crossed_over = False
+                    crossed_over_length = 0
+                    if arrow == previous_arrow:
+                        counts[2] += 1
+
+                if crossed_over:
+                    crossed_over_length += 1
+                    if crossed_over_length >= threshold:
+                        counts[4] += 1
+                        crossed_over = False
+                        active_foot = not active_foot
+                        crossed_over_length = 0
+
+                active_foot = not active_foot
+            previous_arrow = arrow
+
+            if counts is not totals:
+                group_length = min(group_length + 1, 3)
+                has_left = has_left or arrow == "L"
+                has_right = has_right or arrow == "R"
+                if group_length == 3 and has_left and has_right:
+                    for i, count in enumerate(counts):
+                        totals[i] += count
+                    counts = totals
+
+        self._state = (
+            active_foot, previous_arrow, crossed_over, in_footswitch, in_jack,
+            crossed_over_length, group_length, has_left, has_right,
+            None if counts is totals else tuple(counts),
+        )
+
+    def result(self):
+        """Counts for everything added so far, in detect_tech_patterns order"""
+        return tuple(self.totals)
+
+
 def detect_jumps_hands_quads(measure_list):
     """
     Note:
-        this does not account for holds/rolls yet, so songs like
+        this does not account for holds/rolls, so songs like
         Bend Your Mind will produce wildly incorrect results.
+        See freezes.FreezeTracker for hold/roll aware counts.
     :param measure_list:
         List of measures, with list of subdivisions of notes. eg:
         [['0001', '1000', '0100', '0010'], ['0100', '0000', '1001', '0000'], ...]
@@ -163,22 +292,15 @@ def detect_jumps_hands_quads(measure_list):
     jumps = hands = quads = mines = holds = rolls = 0
     for measure in measure_list:
         for subdivision in measure:
-            arrow_counter = 0
-            # indexing each possible step per row
-            for i in range(0, 4):
-                if subdivision[i] in NOTE_TYPES:
-                    arrow_counter += 1
-                if subdivision[i].lower() == "m":
-                    mines += 1
-                if subdivision[i].lower() == "2":
-                    holds += 1
-                if subdivision[i].lower() == "4":
-                    rolls += 1
-            if arrow_counter == 2:
+            info = row_info(subdivision)
+            mines += info.mines
+            holds += info.holds
+            rolls += info.rolls
+            if info.chord == 2:
                 jumps += 1
-            elif arrow_counter == 3:
+            elif info.chord == 3:
                 hands += 1
-            elif arrow_counter == 4:
+            elif info.chord == 4:
                 quads += 1
 
     return (
@@ -189,3 +311,73 @@ def detect_jumps_hands_quads(measure_list):
         holds,
         rolls,
     )
+
+
+class NgramCounter(object):
+    """
+    Counts every window of 1 to max_length consecutive arrows in a
+    generate_arrow_list string that arrives in pieces.
+
+    Arrows are kept as one byte each, and each window is an integer: its
+    arrows as base 6 digits. A window's key is 6 ** length + its code, so
+    windows of different lengths never collide, and with `mirror` the
+    smaller code of the window and its left/right mirror image is used.
+    ngram_name turns keys back into strings.
+    """
+
+    def __init__(self, max_length=8, mirror=True):
+        if max_length < 1:
+            raise ValueError(f"n-gram max_length must be at least 1, got {max_length}")
+        self.max_length = max_length
+        self.mirror = mirror
+        self.arrows = bytearray()
+
+    def add(self, arrows):
+        self.arrows += arrows.encode().translate(NGRAM_ENCODING)
+
+    def result(self):
+        """
+        :return: Counter of {key: count} for every window seen (sparse)
+        """
+        counts = Counter()
+        if not self.arrows:
+            return counts
+
+        window_mod = 6 ** self.max_length
+        # codes[i] holds the last max_length arrows up to and including arrow i
+        codes = list(accumulate(self.arrows, lambda code, arrow: (code * 6 + arrow) % window_mod))
+        if self.mirror:
+            mirrored_arrows = self.arrows.translate(NGRAM_MIRROR)
+            mirrored_codes = list(accumulate(mirrored_arrows, lambda code, arrow: (code * 6 + arrow) % window_mod))
+
+        for length in range(1, self.max_length + 1):
+            length_mod = 6 ** length
+            if self.mirror:
+                counts.update(
+                    length_mod + min(code % length_mod, mirrored_code % length_mod)
+                    for code, mirrored_code in zip(codes[length - 1:], mirrored_codes[length - 1:])
+                )
+            else:
+                counts.update(length_mod + code % length_mod for code in codes[length - 1:])
+        return counts
+
+
+def ngram_name(key):
+    """NgramCounter key -> arrow string, eg. 6 ** 3 + 0 * 36 + 1 * 6 + 3 -> "LDR" """
+    arrows = []
+    while key >= 6:
+        key, arrow = divmod(key, 6)
+        arrows.append(NGRAM_SYMBOLS[arrow])
+    return "".join(reversed(arrows))
+
+
+def count_arrow_ngrams(measure_list, max_length=8, mirror=True):
+    """
+    Count arrow patterns of 1 to max_length arrows in a chart,
+    see NgramCounter
+
+    :return: Counter of {key: count}
+    """
+    counter = NgramCounter(max_length, mirror)
+    counter.add(generate_arrow_list(measure_list))
+    return counter.result()
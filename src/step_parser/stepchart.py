@@ -7,10 +7,12 @@ Goals:
     - measure counter
     - measure breakdown
     - jumps, hands, quads
+    - hold/roll aware jumps, hands, quads, notes during freezes, freeze lengths
     - mines
     - notes per second (NPS)
     - peak NPS (for one measure)
     - bpm changes (count, range)
+    - notes per snap (4th, 8th, 12th, 16th, ...), dominant stream snap
     # Naive implementation:
     - crossover count
     - footswitch count
@@ -25,18 +27,28 @@ Goals:
 
 """
 
+import csv
 import io
+import json
 import os
-import pandas as pd
 import re
+import shutil
 import sys
-
-from statistics import mean, median, mode, stdev, StatisticsError
-
-from step_parser.constants import NOTE_TYPES, ERROR_LOG
-from step_parser.step_patterns import detect_tech_patterns, detect_jumps_hands_quads
+import tempfile
+
+from step_parser.accumulators import IntegerStats, LibrarySummary, RunningStats, median, mode
+from step_parser.archives import count_sm_sources, iter_sm_sources
+from step_parser.constants import CSV_ENCODING, ERROR_LOG, SM_ENCODING
+from step_parser.freezes import FreezeTracker
+from step_parser.incremental import IncrementalChart
+from step_parser.progress import ProgressReporter
+from step_parser.quantization import (
+    SNAP_LEVELS, generate_quantization_index, measure_quantization, snaps_lcm
+)
+from step_parser.rows import row_info
+from step_parser.step_patterns import NgramCounter, TechPatternCounter, ngram_name
 from step_parser.time_calculations import (
-    calculate_average_bpm, calculate_accumulated_measure_time, calculate_measure_nps
+    TimingMap, calculate_average_bpm, calculate_accumulated_measure_time, calculate_measure_nps
 )
 
 
@@ -57,15 +69,38 @@ class NoSinglesChartException(StepchartException):
 
 class Stepchart(object):
     """
+    sm_file may be a path, the raw bytes of a .sm file, or a file object
+    opened in text or binary mode. Paths and bytes are decoded as
+    constants.SM_ENCODING. Pass `name` to label non-path sources in error
+    messages.
+
     self.metadata = {
         <difficulty>:
             ...
     }
     """
 
-    def __init__(self, sm_file, stream_note_threshold=14, stream_size_threshold=2):
+    def __init__(
+        self,
+        sm_file,
+        stream_note_threshold=14,
+        stream_size_threshold=2,
+        stream_note_thresholds=None,
+        name=None,
+        ngram_max_length=None,
+    ):
         self.sm_file = sm_file
+        if name is None:
+            if isinstance(sm_file, (str, os.PathLike)):
+                name = sm_file
+            else:
+                name = getattr(sm_file, "name", "<stream>")
+        self.name = name
         self.stream_note_threshold = stream_note_threshold
+        # optional sweep of extra thresholds, reported as suffixed columns
+        self.stream_note_thresholds = list(stream_note_thresholds or [])
+        # count arrow n-grams up to this length into charts[<difficulty>]["ngram_counts"]
+        self.ngram_max_length = ngram_max_length
         self.stream_size_threshold = stream_size_threshold
         self.difficulties = []
         self.charts = {}
@@ -74,14 +109,33 @@ class Stepchart(object):
         self.in_measure_time_metadata = []      # store bpm and stop data by measure
         self.metadata = {}       # store desired features here!
         self.streams = []
+        self.timing_map = None                  # beat -> seconds, see TimingMap
+        self._incremental_charts = {}   # difficulty: IncrementalChart, built on first edit
         self._metadata_generated = False
         self._parse_sm_file()
         self._generate_metadata()
 
+    def _read_sm_file(self):
+        """Return the text of self.sm_file, whatever kind of source it is"""
+        if isinstance(self.sm_file, bytes):
+            return self._decode(io.BytesIO(self.sm_file))
+        if hasattr(self.sm_file, "read"):
+            sm_contents = self.sm_file.read()
+            if isinstance(sm_contents, bytes):
+                return self._decode(io.BytesIO(sm_contents))
+            return sm_contents
+        with io.open(self.sm_file, "r", encoding=SM_ENCODING) as f:
+            return f.read()
+
+    @staticmethod
+    def _decode(binary_file):
+        """Decode .sm bytes as SM_ENCODING, with the newline handling of a path opened in text mode"""
+        with io.TextIOWrapper(binary_file, encoding=SM_ENCODING) as f:
+            return f.read()
+
     def _parse_sm_file(self):
         """Reads SM file and populates: difficulties, charts, and metadata"""
-        with io.open(self.sm_file, "r") as f:
-            sm_contents = f.read()
+        sm_contents = self._read_sm_file()
 
         # Strip out comments, trailing whitespace
         sm_contents = re.sub(r"//[^\n]*", "", sm_contents)
@@ -117,7 +171,7 @@ class Stepchart(object):
                     self.raw_metadata[header.strip().upper()] = info
 
         if len(self.difficulties) == 0:
-            raise NoSinglesChartException(f"{self.sm_file} has no dance-single stepcharts")
+            raise NoSinglesChartException(f"{self.name} has no dance-single stepcharts")
 
     def _generate_metadata(self):
         # Pull some of the raw #HEADER style metadata from the .sm file and add it to our feature set
@@ -136,17 +190,17 @@ class Stepchart(object):
                 }
             if difficulty not in self.raw_metadata:
                 self.raw_metadata[difficulty] = {}
-            self._generate_measures(difficulty)
-            self._generate_stream_breakdown(difficulty)
-            self._generate_stream_stats(difficulty)
-            self._extract_jumps_hands_quads(difficulty)
-            self._generate_step_density(difficulty)
-            self._generate_tech_metadata(difficulty)
+            self._analyze_measures(difficulty)
 
         self._generate_secondary_time_metadata()
         self._metadata_generated = True
 
     def _generate_measures(self, difficulty=None):
+        """
+        Split a difficulty's raw_data into charts[difficulty]["measure_list"].
+        Metadata generation streams measures instead (see _analyze_measures),
+        this is for callers that need random access, like edit_measures.
+        """
         if difficulty is None:
             difficulty = self.difficulties[0]
         if difficulty not in self.charts:
@@ -154,48 +208,31 @@ class Stepchart(object):
                 f"{difficulty} not in simfile. Options: {self.difficulties}"
             )
 
-        measure_data = self.charts[difficulty]["raw_data"]
-        raw_measures = measure_data.split(',')
-        measures = [
-            [
-                subdivision.strip()
-                for subdivision
-                in measure.strip().split("\n")
-            ]
-            for measure
-            in raw_measures
-            if measure
-        ]
+        measures = list(iter_measures(self.charts[difficulty]["raw_data"]))
         self.charts[difficulty]["measure_list"] = measures
 
     # TODO: make this work with NPS threshold instead note per measure threshold
-    def _generate_stream_breakdown(self, difficulty):
+    def _generate_stream_breakdown(self, difficulty, stream_note_threshold=None, suffix=""):
         """
         Sample Breakdown: ["(16)", "32", "(4)", "16", "(16)", "64", "(8)"]
             * "(#)" == measures of break
             * "#"   == measures of stream
 
-        A measure is a "stream" if `self.stream_note_threshold` or more
-        subdivisions in that measure have notes
+        A measure is a "stream" if `stream_note_threshold` (defaults to
+        `self.stream_note_threshold`) or more subdivisions in that measure
+        have notes. Results are stored under "stream_total<suffix>" and
+        "breakdown<suffix>".
         """
-        if not self.charts[difficulty].get("measure_list"):
-            self._generate_measures(difficulty)
-
-        measures = self.charts[difficulty]["measure_list"]
+        if stream_note_threshold is None:
+            stream_note_threshold = self.stream_note_threshold
+        measure_note_counts = self.charts[difficulty]["measure_note_counts"]
         stream_total = 0
         active_measure_counter = 0
         breakdown = []
         in_stream = False
 
-        for measure in measures:
-            # counting subdivisions that have notes in them
-            subdivision_counter = 0
-            if len(measure) >= self.stream_note_threshold:
-                for subdivision in measure:
-                    if any([i in subdivision for i in NOTE_TYPES]):
-                        subdivision_counter += 1
-
-            if subdivision_counter >= self.stream_note_threshold:
+        for subdivision_counter in measure_note_counts:
+            if subdivision_counter >= stream_note_threshold:
                 if not in_stream:
                     breakdown.append(f"({active_measure_counter})")
                     active_measure_counter = 0
@@ -215,44 +252,72 @@ class Stepchart(object):
         else:
             breakdown.append(f"({active_measure_counter})")
 
-        self.metadata[difficulty]["stream_total"] = stream_total
-        self.metadata[difficulty]["breakdown"] = breakdown
+        self.metadata[difficulty][f"stream_total{suffix}"] = stream_total
+        self.metadata[difficulty][f"breakdown{suffix}"] = breakdown
 
-    def _generate_stream_stats(self, difficulty):
+    def _generate_stream_stats(self, difficulty, suffix=""):
         """
-        Add stream and break distribution stats to self.metadata, for a given difficulty
+        Add stream and break distribution stats to self.metadata, for a given difficulty.
+        `suffix` selects which breakdown to summarize (see _generate_stream_breakdown)
         """
-        breakdown = self.metadata[difficulty]["breakdown"]
-        stream_groups = [
-            int(group)
-            for group in breakdown
-            if not group.startswith("(")
-        ]
-        break_groups = [
-            int(group.strip("(").strip(")"))
-            for group in breakdown
-            if group.startswith("(")
-        ]
-        if stream_groups:
-            self.metadata[difficulty]["stream_count"] = len(stream_groups)
-            self.metadata[difficulty]["stream_size_max"] = max(stream_groups)
-            self.metadata[difficulty]["stream_size_avg"] = mean(stream_groups)
-            self.metadata[difficulty]["stream_total"] = sum(stream_groups)
-            if len(stream_groups) >= 2:
-                self.metadata[difficulty]["stream_size_std"] = stdev(stream_groups)
-
-        if len(break_groups) >= 2:
-            self.metadata[difficulty]["break_count"] = len(break_groups)
-            self.metadata[difficulty]["break_size_max"] = max(break_groups)
-            self.metadata[difficulty]["break_size_avg"] = mean(break_groups)
-            self.metadata[difficulty]["break_total"] = sum(break_groups)
-            if len(break_groups) >= 2:
-                self.metadata[difficulty]["break_size_std"] = stdev(break_groups)
-
-        if len(self.charts[difficulty]["measure_list"]) != sum(stream_groups + break_groups):
-            print(f"Math bad: {len(self.charts[difficulty]['measure_list'])} != {sum(stream_groups + break_groups)} ")
-
-        self.metadata[difficulty]["measure_count"] = len(self.charts[difficulty]["measure_list"])
+        stream_stats = IntegerStats()
+        break_stats = IntegerStats()
+        for group in self.metadata[difficulty][f"breakdown{suffix}"]:
+            if group.startswith("("):
+                break_stats.add(int(group.strip("(").strip(")")))
+            else:
+                stream_stats.add(int(group))
+        self._record_stream_stats(difficulty, stream_stats, break_stats, suffix)
+
+        measure_count = len(self.charts[difficulty]["measure_note_counts"])
+        if measure_count != stream_stats.total + break_stats.total:
+            print(f"Math bad: {measure_count} != {stream_stats.total + break_stats.total} ")
+
+        self.metadata[difficulty]["measure_count"] = measure_count
+
+    def _record_stream_stats(self, difficulty, stream_stats, break_stats, suffix=""):
+        """
+        Record stream and break group stats for a breakdown, from
+        accumulators.IntegerStats of its stream and break group sizes
+        """
+        metadata = self.metadata[difficulty]
+        if stream_stats.count:
+            metadata[f"stream_count{suffix}"] = stream_stats.count
+            metadata[f"stream_size_max{suffix}"] = stream_stats.max
+            metadata[f"stream_size_avg{suffix}"] = stream_stats.mean
+            metadata[f"stream_total{suffix}"] = stream_stats.total
+            if stream_stats.count >= 2:
+                metadata[f"stream_size_std{suffix}"] = stream_stats.std
+
+        if break_stats.count >= 2:
+            metadata[f"break_count{suffix}"] = break_stats.count
+            metadata[f"break_size_max{suffix}"] = break_stats.max
+            metadata[f"break_size_avg{suffix}"] = break_stats.mean
+            metadata[f"break_total{suffix}"] = break_stats.total
+            metadata[f"break_size_std{suffix}"] = break_stats.std
+
+    def _generate_quantization_index(self, difficulty):
+        """
+        Record each row's beat within its measure and snap level, see
+        quantization.generate_quantization_index
+        """
+        if not self.charts[difficulty].get("measure_list"):
+            self._generate_measures(difficulty)
+
+        self.charts[difficulty]["quantization_index"] = generate_quantization_index(
+            self.charts[difficulty]["measure_list"]
+        )
+
+    def _generate_stream_threshold_sweep(self, difficulty):
+        """
+        Build a suffixed breakdown and stream stats (eg. "breakdown_16",
+        "stream_size_max_16") for every threshold in
+        self.stream_note_thresholds, reusing the per-measure note counts.
+        """
+        for threshold in self.stream_note_thresholds:
+            suffix = f"_{threshold}"
+            self._generate_stream_breakdown(difficulty, threshold, suffix)
+            self._generate_stream_stats(difficulty, suffix)
 
     def _extract_time_metadata(self):
         """
@@ -311,15 +376,12 @@ class Stepchart(object):
         ]
 
         sample_difficulty = self.difficulties[0]
-        sample_chart_metadata = self.charts[sample_difficulty]
-        if "measure_list" not in sample_chart_metadata:
-            self._generate_measures(sample_difficulty)
-        sample_chart = self.charts[sample_difficulty]["measure_list"]
+        sample_measure_count = count_measures(self.charts[sample_difficulty]["raw_data"])
 
         in_measure_time_metadata = []
         previous_measure = None
 
-        for measure_number in range(len(sample_chart)):
+        for measure_number in range(sample_measure_count):
             measure_bpms = [
                 (beat, bpm)
                 for measure, beat, bpm in bpms
@@ -335,7 +397,7 @@ class Stepchart(object):
             if not measure_bpms:
                 # if it's the first measure, something is wrong
                 if measure_number == 0:
-                    raise StepchartException(f"SM file has no BPM at beat 0: {self.sm_file}")
+                    raise StepchartException(f"SM file has no BPM at beat 0: {self.name}")
 
                 previous_measure_bpms = [i for i in previous_measure if "stop" not in i]
                 _, last_bpm = previous_measure_bpms[-1]
@@ -392,123 +454,294 @@ class Stepchart(object):
         self.metadata["song_seconds"] = song_seconds
         return song_seconds
 
-    def _calculate_step_count(self, difficulty):
-        """
-        Calculate number of steps, holds, and rolls for a single difficulty
+    def _analyze_measures(self, difficulty):
         """
-        if "step_count" in self.metadata[difficulty]:
-            return self.metadata[difficulty]["step_count"]
-        if not self.charts[difficulty].get("measure_list"):
-            self._generate_measures(difficulty)
-        measure_list = self.charts[difficulty]["measure_list"]
-        step_count = 0
-        for measure in measure_list:
-            for subdivision in measure:
-                for slot in subdivision:
-                    if slot in NOTE_TYPES:
-                        step_count += 1
-        self.metadata[difficulty]["step_count"] = step_count
-        return step_count
+        Generate the per-difficulty metadata in a single pass over the chart:
+        stream breakdowns and stats, notes per snap, jumps/hands/quads,
+        mines, holds, rolls, steps, NPS (notes-per-second) distribution and
+        tech patterns.
 
-    def _generate_step_density(self, difficulty):
-        """
-        Add NPS (notes-per-second) distribution to self.metadata.
+        Measures are split off raw_data one at a time (see iter_measures) and
+        each one is handed to every feature's accumulator before the next is
+        read, so memory is bounded by one measure plus the accumulators
+        (per-measure note counts, the current arrow group), however long the
+        chart is.
 
         Note: NPS measurements for a point in time need a sliding window to
               count, so we just use measures. This makes them
               "notes-per-second-per-measure"
         """
-        if not self.charts[difficulty].get("measure_list"):
-            self._generate_measures(difficulty)
-
-        measure_list = self.charts[difficulty]["measure_list"]
+        metadata = self.metadata[difficulty]
         time_metadata = self.in_measure_time_metadata
 
-        step_count = self._calculate_step_count(difficulty)
-        song_seconds = self._calculate_song_length()
-        song_nps = float(step_count) / float(song_seconds)
-        nps_per_measure = []
+        measure_note_counts = []
+        step_count = 0
+        jump_hand_quad_counts = [0] * 6     # jumps, hands, quads, mines, holds, rolls
+        snap_counts = {}
+        stream_snap_counts = {}
+        nps_stats = RunningStats()
+        # One value per measure, like measure_note_counts. The median has to
+        # stay exact: a QuantileSketch is only exact up to ~200 values, and
+        # past that a chart's median would depend on the order of its
+        # measures, so an edit that puts the same values back could move it
+        measure_nps_values = []
+        nps_counts = {}
+        tech_patterns = TechPatternCounter()
+        ngrams = NgramCounter(self.ngram_max_length) if self.ngram_max_length is not None else None
+        freezes = FreezeTracker(self._get_timing_map())
+        measure_count = 0
+
+        for measure_number, measure in enumerate(iter_measures(self.charts[difficulty]["raw_data"])):
+            quantization = measure_quantization(len(measure))
+            # every row is looked up once here, and the RowInfo and the
+            # tallies below are handed on to the freeze, snap and NPS code
+            row_infos = [row_info(subdivision) for subdivision in measure]
+            note_count = 0
+            measure_step_count = 0
+            arrows = []
+            note_snaps = set()
+            for row, (subdivision, info, (beat, snap)) in enumerate(zip(measure, row_infos, quantization)):
+                if info.notes:
+                    note_count += 1
+                    measure_step_count += info.notes
+                    snap_counts[snap] = snap_counts.get(snap, 0) + 1
+                    note_snaps.add(snap)
+                    arrows.append(info.arrow)
+                if freezes.needs_row(subdivision, info):
+                    freezes.add_row(subdivision, measure_number, row, beat, info)
+                if info.chord:
+                    jump_hand_quad_counts[info.chord - 2] += 1
+                if info.mines or info.holds or info.rolls:
+                    jump_hand_quad_counts[3] += info.mines
+                    jump_hand_quad_counts[4] += info.holds
+                    jump_hand_quad_counts[5] += info.rolls
+            measure_note_counts.append(note_count)
+            step_count += measure_step_count
+            if note_count >= self.stream_note_threshold:
+                stream_snap = snaps_lcm(note_snaps)
+                stream_snap_counts[stream_snap] = stream_snap_counts.get(stream_snap, 0) + 1
 
-        for measure_number, measure in enumerate(measure_list):
             if measure_number < len(time_metadata):
-                measure_nps = calculate_measure_nps(measure, time_metadata[measure_number])
-                nps_per_measure.append(measure_nps)
+                measure_nps = calculate_measure_nps(
+                    measure, time_metadata[measure_number], note_count=measure_step_count
+                )
+                nps_stats.add(measure_nps)
+                measure_nps_values.append(measure_nps)
+                nps_counts[measure_nps] = nps_counts.get(measure_nps, 0) + 1
+
+            arrows = "".join(arrows)
+            tech_patterns.add(arrows)
+            if ngrams is not None:
+                ngrams.add(arrows)
+            measure_count += 1
+
+        self.charts[difficulty]["measure_note_counts"] = measure_note_counts
+        freeze_index = freezes.finish(measure_count)
+        if ngrams is not None:
+            self.charts[difficulty]["ngram_counts"] = ngrams.result()
+        self.charts[difficulty]["freeze_index"] = freeze_index
+
+        # Record features in the order they have always been reported in
+        self._generate_stream_breakdown(difficulty)
+        self._generate_stream_stats(difficulty)
+        self._generate_stream_threshold_sweep(difficulty)
+
+        for snap in SNAP_LEVELS:
+            metadata[f"snap_{snap}_count"] = snap_counts.get(snap, 0)
+        metadata["snap_other_count"] = sum(
+            count for snap, count in snap_counts.items() if snap not in SNAP_LEVELS
+        )
+        if stream_snap_counts:
+            metadata["stream_snap"] = max(
+                stream_snap_counts.items(), key=lambda x: (x[1], -x[0])
+            )[0]
+
+        for key, count in zip(["jumps", "hands", "quads", "mines", "holds", "rolls"], jump_hand_quad_counts):
+            metadata[key] = count
+        self._record_freeze_metadata(
+            difficulty, freeze_index, freezes.freeze_notes, freezes.jump_hand_quad_changes
+        )
 
-        self.metadata[difficulty]["song_nps"] = song_nps
-        self.metadata[difficulty]["nps_per_measure_max"] = max(nps_per_measure)
-        self.metadata[difficulty]["nps_per_measure_avg"] = mean(nps_per_measure)
-        self.metadata[difficulty]["nps_per_measure_median"] = median(nps_per_measure)
-        if len(nps_per_measure) >= 2:
-            self.metadata[difficulty]["nps_per_measure_std"] = stdev(nps_per_measure)
-        try:
-            self.metadata[difficulty]["nps_per_measure_mode"] = mode(nps_per_measure)
-        except StatisticsError:
-            self.metadata[difficulty]["nps_per_measure_mode"] = "bimodal"
+        metadata["step_count"] = step_count
+        metadata["song_nps"] = float(step_count) / float(self._calculate_song_length())
+        metadata["nps_per_measure_max"] = nps_stats.max
+        metadata["nps_per_measure_avg"] = nps_stats.mean
+        metadata["nps_per_measure_median"] = median(sorted(measure_nps_values))
+        if nps_stats.count >= 2:
+            metadata["nps_per_measure_std"] = nps_stats.std
+        metadata["nps_per_measure_mode"] = mode(nps_counts)
 
-    def _extract_jumps_hands_quads(self, difficulty):
+        (
+            metadata["crossovers"],
+            metadata["footswitches"],
+            metadata["crossover_footswitches"],
+            metadata["jacks"],
+            metadata["invalid_crossovers"],
+        ) = tech_patterns.result()
+
+    def _get_timing_map(self):
+        if self.timing_map is None:
+            self.timing_map = TimingMap(self.time_metadata["bpms"], self.time_metadata["stops"])
+        return self.timing_map
+
+    def _record_freeze_metadata(self, difficulty, freeze_index, freeze_notes, jump_hand_quad_changes):
         """
-        Record the number of jumps, hands, quads, mines, holds, and rolls for a difficulty
+        Record hold/roll aware features for a difficulty:
+            * freeze_jumps/hands/quads - jumps, hands and quads counting held
+              freezes as arrows (a jump while holding a freeze is a hand)
+            * freeze_notes - notes hit while a freeze is held
+            * freeze_max_concurrent - most freezes held at once
+            * hold_seconds, roll_seconds - summed freeze lengths
+            * freeze_held_ratio - fraction of the song with a freeze held
         """
-        if not self.charts[difficulty].get("measure_list"):
-            self._generate_measures(difficulty)
+        metadata = self.metadata[difficulty]
+        for key, change in zip(["jumps", "hands", "quads"], jump_hand_quad_changes):
+            metadata[f"freeze_{key}"] = metadata[key] + change
+        metadata["freeze_notes"] = freeze_notes
+        metadata["freeze_max_concurrent"] = freeze_index.max_concurrent
+        metadata["hold_seconds"] = freeze_index.hold_seconds
+        metadata["roll_seconds"] = freeze_index.roll_seconds
+        # freeze seconds come from the TimingMap, so the song length has to as well
+        timing_map = self._get_timing_map()
+        chart_seconds = timing_map.seconds_at(4 * freeze_index.measure_count) - timing_map.seconds_at(0)
+        metadata["freeze_held_ratio"] = freeze_index.held_seconds / chart_seconds if chart_seconds > 0 else 0.0
+
+    def edit_measures(self, difficulty, start, end, new_measures):
+        """
+        Replace measures [start, end) of a difficulty with new_measures and
+        update self.metadata.
+
+        When the measure count is unchanged, only the edited measures and the
+        aggregates that depend on them are recomputed (see
+        incremental.IncrementalChart). Edits that insert or remove measures
+        change the song's timing, so they rebuild all metadata instead.
+
+        charts[difficulty]["measure_list"] is always current. "raw_data" is
+        rewritten from it on a rebuild, for every difficulty, so a rebuild
+        keeps earlier same-count edits to other difficulties.
+
+        :param difficulty:    difficulty to edit, eg. "Challenge"
+        :param start:         first measure to replace
+        :param end:           measure after the last one to replace
+        :param new_measures:  list of measures, each a list of rows. eg:
+                              [['0001', '1000', '0100', '0010'], ...]
+        :raises IndexError:   if [start, end) isn't a range of the chart's measures
+        """
+        if difficulty not in self.charts:
+            raise StepchartException(
+                f"{difficulty} not in simfile. Options: {self.difficulties}"
+            )
 
+        if "measure_list" not in self.charts[difficulty]:
+            self._generate_measures(difficulty)
         measures = self.charts[difficulty]["measure_list"]
-        jumps, hands, quads, mines, holds, rolls = detect_jumps_hands_quads(measures)
-
-        self.metadata[difficulty]["jumps"] = jumps
-        self.metadata[difficulty]["hands"] = hands
-        self.metadata[difficulty]["quads"] = quads
-        self.metadata[difficulty]["mines"] = mines
-        self.metadata[difficulty]["holds"] = holds
-        self.metadata[difficulty]["rolls"] = rolls
+        if not 0 <= start <= end <= len(measures):
+            raise IndexError(
+                f"edit of measures [{start}, {end}) is outside of {len(measures)} measures"
+            )
 
-    def _generate_tech_metadata(self, difficulty):
-        """
-        Discover and record tech patterns (eg. crossovers, footswitches, jacks)
-        for a specific difficulty
-        """
-        (
-            crossovers,
-            footswitches,
-            crossover_footswitches,
-            jacks,
-            invalid_crossovers
-        ) = detect_tech_patterns(self.charts[difficulty]["measure_list"])
-        self.metadata[difficulty]["crossovers"] = crossovers
-        self.metadata[difficulty]["footswitches"] = footswitches
-        self.metadata[difficulty]["crossover_footswitches"] = crossover_footswitches
-        self.metadata[difficulty]["jacks"] = jacks
-        self.metadata[difficulty]["invalid_crossovers"] = invalid_crossovers
+        if end - start == len(new_measures):
+            if difficulty not in self._incremental_charts:
+                self._incremental_charts[difficulty] = IncrementalChart(self, difficulty)
+            self._incremental_charts[difficulty].edit_measures(start, new_measures)
+            return
+
+        measures[start:end] = [[row.strip() for row in measure] for measure in new_measures]
+        self._rebuild_metadata()
+
+    def _rebuild_metadata(self):
+        """Throw away all generated metadata and regenerate it from charts' raw_data"""
+        for chart in self.charts.values():
+            # measure_list may hold edits that raw_data doesn't have yet
+            if "measure_list" in chart:
+                chart["raw_data"] = ",\n".join("\n".join(measure) for measure in chart["measure_list"])
+            for key in list(chart):
+                if key not in ("mode", "description", "difficulty", "rating", "numbers", "raw_data"):
+                    del chart[key]
+        self.metadata = {}
+        self.in_measure_time_metadata = []
+        self._incremental_charts = {}
+        self._generate_metadata()
 
-    def metadata_df(self):
+    def metadata_records(self):
         """
-        Place relevant metadata for song in a pandas DataFrame,
-        one row per difficulty.
+        Relevant metadata for song as plain dicts, one per difficulty.
+        Song level metadata (title, bpms, ...) is repeated in each record.
         """
-        dfs = []
+        records = []
         song_metadata = {
-            k: [v]
+            k: v
             for k, v in self.metadata.items()
             if k not in self.difficulties
         }
-        for i, difficulty in enumerate(self.difficulties):
+        for difficulty in self.difficulties:
             difficulty_metadata = self.metadata[difficulty].copy()
             difficulty_metadata.update(song_metadata)
-            difficulty_metadata["breakdown"] = "-".join(difficulty_metadata["breakdown"])
-            dfs.append(pd.DataFrame(difficulty_metadata))
+            for key, value in difficulty_metadata.items():
+                if key.startswith("breakdown"):
+                    difficulty_metadata[key] = "-".join(value)
+            records.append(difficulty_metadata)
+        return records
 
-        df = pd.concat(dfs, ignore_index=True, sort=False)
-        return df
+    def ngram_records(self):
+        """
+        Arrow n-gram counts (see step_patterns.NgramCounter), one dict per
+        difficulty in the same order as metadata_records. Requires
+        ngram_max_length.
+        """
+        return [self.charts[difficulty]["ngram_counts"] for difficulty in self.difficulties]
+
+    def metadata_df(self):
+        """
+        Place relevant metadata for song in a pandas DataFrame,
+        one row per difficulty.
+        """
+        pd = import_pandas()
+        return pd.DataFrame(self.metadata_records())
+
+
+def import_pandas():
+    """pandas, for DataFrame output. It's an optional dependency, so fail with how to get it"""
+    try:
+        import pandas as pd
+    except ImportError:
+        raise ImportError(
+            'DataFrame output needs pandas: pip install "sm_tools[pandas]", '
+            "or pass as_dataframe=False to get a list of dicts"
+        )
+    return pd
+
+
+def iter_measures(raw_data):
+    """
+    Yield the measures of a chart's raw note data one at a time, as lists
+    of rows. eg: ['0001', '1000', '0100', '0010'], ['0100', '0000', ...], ...
+    """
+    for raw_measure in re.finditer(r"[^,]+", raw_data):
+        yield [
+            subdivision.strip()
+            for subdivision
+            in raw_measure.group().strip().split("\n")
+        ]
+
+
+def count_measures(raw_data):
+    """Number of measures iter_measures(raw_data) yields, without splitting rows"""
+    return sum(1 for _ in re.finditer(r"[^,]+", raw_data))
 
 
-def analyze_stepchart(sm_file_name):
+def analyze_stepchart(sm_file_name, stream_note_thresholds=None, as_dataframe=True, name=None):
     """
-    :param sm_file_name: path to .sm file
-    :return:             pd.DataFrame of song metadata
+    :param sm_file_name:            path to .sm file, its bytes, or a file object (see Stepchart)
+    :param stream_note_thresholds:  optional list of extra stream thresholds to sweep
+    :param as_dataframe:            return a DataFrame (requires pandas) instead of records
+    :param name:                    label for sm_file_name in error messages
+    :return:                        pd.DataFrame of song metadata, or list of dicts
     """
-    stepchart = Stepchart(sm_file_name)
-    df = stepchart.metadata_df()
-    return df
+    stepchart = Stepchart(sm_file_name, stream_note_thresholds=stream_note_thresholds, name=name)
+    if as_dataframe:
+        return stepchart.metadata_df()
+    return stepchart.metadata_records()
 
 
 def sm_file_search(target_dir):
@@ -531,63 +764,209 @@ def log_error(msg):
         f.writelines([f"{msg}\n"])
 
 
+def write_records_csv(records, output_file):
+    """
+    Write metadata records to a csv laid out like DataFrame.to_csv: an
+    unnamed index column, then the union of all record keys in the order
+    they first appear. Missing values are left empty.
+    """
+    fieldnames = []
+    seen = set()
+    for record in records:
+        for key in record:
+            if key not in seen:
+                seen.add(key)
+                fieldnames.append(key)
+
+    with open(output_file, "w", newline="", encoding=CSV_ENCODING) as f:
+        writer = csv.writer(f)
+        writer.writerow([""] + fieldnames)
+        for i, record in enumerate(records):
+            writer.writerow([i] + [
+                "" if record.get(key) is None else record[key]
+                for key in fieldnames
+            ])
+
+
+class SparseMatrixWriter(object):
+    """
+    Writes rows of sparse counts to a Matrix Market coordinate file
+    (scipy.io.mmread can load it), one row at a time. Columns are numbered
+    in the order their keys are first seen, and their names are written to
+    "<path>.columns.txt", one per line.
+    """
+
+    def __init__(self, path, column_name=str):
+        self.path = path
+        self.column_name = column_name
+        self.columns = {}
+        self.row_count = 0
+        self.entry_count = 0
+        # the header needs the final shape, so entries wait in a temp file
+        self._entries = tempfile.TemporaryFile("w+")
+
+    def add_row(self, counts):
+        self.row_count += 1
+        for key, count in counts.items():
+            if key not in self.columns:
+                self.columns[key] = len(self.columns) + 1
+            self._entries.write(f"{self.row_count} {self.columns[key]} {count}\n")
+            self.entry_count += 1
+
+    def close(self):
+        with open(self.path, "w") as f:
+            f.write("%%MatrixMarket matrix coordinate integer general\n")
+            f.write(f"{self.row_count} {len(self.columns)} {self.entry_count}\n")
+            self._entries.seek(0)
+            shutil.copyfileobj(self._entries, f)
+        self._entries.close()
+        with open(f"{self.path}.columns.txt", "w") as f:
+            f.writelines(f"{self.column_name(key)}\n" for key in self.columns)
+
+
+def write_library_summary(library_summary, summary_file):
+    """Write a LibrarySummary to json, with its state so runs can be merged later"""
+    with open(summary_file, "w") as f:
+        json.dump(
+            {
+                "summary": library_summary.summary(),
+                "state": library_summary.to_dict(),
+            },
+            f,
+            indent=2,
+        )
+
+
 # TODO: make the csv drop optional
-def batch_analysis(target_dir, output_file=None, raise_on_unknown_failure=False):
+def batch_analysis(
+    target_dir,
+    output_file=None,
+    raise_on_unknown_failure=False,
+    stream_note_thresholds=None,
+    as_dataframe=True,
+    summary_file=None,
+    progress_json=None,
+    ngram_file=None,
+    ngram_max_length=8,
+):
     """
     Recursively search target_dir for .sm files and extract metadata
-    from each. Concat all of the resulting metadata dataframes into
-    one, and write it to output_file as a csv.
+    from each. Concat all of the resulting metadata into one table,
+    and write it to output_file as a csv.
+
+    Zip and tar song packs (in target_dir, or passed as target_dir) are
+    read in place, and their charts are reported as
+    "Pack.zip!/Pack/Song/Song.sm".
 
-    :param target_dir:  directory to scan
+    :param target_dir:  directory or song pack archive to scan
     :param output_file: where to write resulting dataframe
     :param raise_on_unknown_failure:
         bool [default=false] - break analysis run on unrecognized exception (for debugging)
-    :return: resulting pd.DataFrame of concatenated metadata
+    :param stream_note_thresholds:
+        list of ints [default=None] - extra stream thresholds, each chart is parsed
+        once and every threshold adds "_<threshold>" suffixed stream columns
+    :param as_dataframe:
+        bool [default=True] - return a pd.DataFrame. If False, pandas is never
+        imported and a list of dicts (one per chart) is returned instead.
+        If True and pandas isn't installed, ImportError is raised before
+        anything is analyzed
+    :param summary_file:
+        where to write a json summary (count, mean, std, min, max, quantiles)
+        of every numeric feature over the whole library. It is accumulated
+        chart by chart, and includes the mergeable sketch state under "state"
+        (see accumulators.LibrarySummary.from_dict) to combine runs.
+    :param progress_json:
+        path or file object to write progress events to as JSON lines
+        (files/notes/bytes per second, ETA, errors, current file; see progress.py)
+    :param ngram_file:
+        where to write arrow n-gram counts (see step_patterns.NgramCounter) as
+        a sparse Matrix Market file, one row per chart in the same order as
+        the csv, plus "<ngram_file>.columns.txt" naming each column
+    :param ngram_max_length:
+        int [default=8] - longest n-gram counted for ngram_file, at least 1
+    :return: resulting pd.DataFrame of concatenated metadata, or list of dicts
     """
-    sm_files = sm_file_search(target_dir)
-    print(
-        f"Found {len(sm_files)} .sm files. Running analysis. "
-        f"'.'=success, "
-        f"'X'=failure, "
-        f"'0'=no singles stepchart"
-    )
-    dfs = []
-    sm_file_counter = 0
-
-    for sm_file in sm_files:
-        try:
-            dfs.append(analyze_stepchart(sm_file))
-            print(".", end="", flush=True)
-        except UnicodeDecodeError:
-            print("X", end="", flush=True)
-            log_error(f"ERROR: UnicodeDecodeError - {sm_file}")
-        except NoSinglesChartException:
-            print("0", end="", flush=True)
-            log_error(f"WARN: - {sm_file} contains no dance-single stepcharts")
-        except Exception as e:
-            print("X", end="", flush=True)
-            log_error(f"ERROR: Failed to process {sm_file}")
-            log_error(str(sys.exc_info()))
-            log_error(str(e))
-            if raise_on_unknown_failure:
-                print(f"\nERROR: failed to handle {sm_file}\n")
-                raise e
-
-        sm_file_counter += 1
-        if sm_file_counter % 50 == 0:
-            print("")
-        if sm_file_counter % 500 == 0:
-            print(f"{sm_file_counter} files processed")
-
-    print("\nAnalysis complete!")
-    if len(dfs) >= 1:
-        print("Merging dataframes")
-        results_df = pd.concat(dfs, ignore_index=True, sort=False)
+    # fail before the run, not after analyzing the whole library
+    pd = import_pandas() if as_dataframe else None
+    if ngram_file and (ngram_max_length is None or ngram_max_length < 1):
+        raise ValueError(f"ngram_max_length must be at least 1, got {ngram_max_length}")
+
+    files_total = count_sm_sources(target_dir)
+    if files_total is None:
+        print("Running analysis (.sm file count unknown until tar archives are read).")
     else:
-        results_df = pd.DataFrame()
+        print(f"Found {files_total} .sm files. Running analysis.")
+    records = []
+    library_summary = LibrarySummary()
+    progress = ProgressReporter(files_total, json_file=progress_json)
+    ngram_writer = SparseMatrixWriter(ngram_file, ngram_name) if ngram_file else None
+
+    def archive_error(name, e):
+        # an unreadable archive (or archive member) counts as one failed file
+        progress.start_file(name)
+        log_error(f"ERROR: Failed to read archive {name}")
+        log_error(f"{type(e).__name__}: {e}")
+        progress.finish_file(error_category=type(e).__name__)
+
+    try:
+        for sm_file, sm_source, sm_size in iter_sm_sources(target_dir, on_error=archive_error):
+            progress.start_file(sm_file)
+            notes = 0
+            error_category = None
+            try:
+                stepchart = Stepchart(
+                    sm_source,
+                    stream_note_thresholds=stream_note_thresholds,
+                    name=sm_file,
+                    ngram_max_length=ngram_max_length if ngram_writer else None,
+                )
+                sm_records = stepchart.metadata_records()
+                if ngram_writer:
+                    for ngram_counts in stepchart.ngram_records():
+                        ngram_writer.add_row(ngram_counts)
+                for record in sm_records:
+                    library_summary.add_record(record)
+                    notes += record["step_count"]
+                records.extend(sm_records)
+            except UnicodeDecodeError as e:
+                error_category = type(e).__name__
+                log_error(f"ERROR: UnicodeDecodeError - {sm_file}")
+            except NoSinglesChartException as e:
+                error_category = type(e).__name__
+                log_error(f"WARN: - {sm_file} contains no dance-single stepcharts")
+            except Exception as e:
+                error_category = type(e).__name__
+                log_error(f"ERROR: Failed to process {sm_file}")
+                log_error(str(sys.exc_info()))
+                log_error(str(e))
+                if raise_on_unknown_failure:
+                    print(f"\nERROR: failed to handle {sm_file}\n")
+                    raise e
+            progress.finish_file(notes, sm_size, error_category)
+    except BaseException as e:
+        progress.close(error=e)
+        raise
+    progress.close()
+
+    print("Analysis complete!")
+    if ngram_writer:
+        print(f"Writing arrow n-grams to {ngram_file}")
+        ngram_writer.close()
+    if summary_file:
+        print(f"Writing library summary to {summary_file}")
+        write_library_summary(library_summary, summary_file)
+
+    if as_dataframe:
+        print("Merging dataframes")
+        results = pd.DataFrame(records)
+        if output_file:
+            print(f"Writing results to {output_file}")
+            results.to_csv(output_file)
+            print("Done writing to file")
+        return results
 
     if output_file:
         print(f"Writing results to {output_file}")
-        results_df.to_csv(output_file)
+        write_records_csv(records, output_file)
         print("Done writing to file")
-    return results_df
+    return records
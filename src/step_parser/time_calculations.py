@@ -1,4 +1,6 @@
-from step_parser.constants import NOTE_TYPES
+from bisect import bisect_left, bisect_right
+
+from step_parser.rows import row_info
 
 
 def calculate_average_bpm(bpm_map, song_length_beats):
@@ -69,12 +71,14 @@ def calculate_accumulated_measure_time(bpms, stops):
     return accumulated_seconds
 
 
-def calculate_measure_nps(measure_notes, measure_time_data):
+def calculate_measure_nps(measure_notes, measure_time_data, note_count=None):
     """
     Assumes 4 beats per measure
 
     :param measure_notes:       eg. [0001, 1000, 0100, 0010, ...]
     :param measure_time_data:   eg. [(0.0, 165.0), (2.0, 200), (2.0, "stop", 0.1)]
+    :param note_count:          notes, holds and rolls in measure_notes, if the
+                                caller has already tallied them
     :return: average notes per second for the measure
     """
     bpms = sorted([i for i in measure_time_data if "stop" not in i], key=lambda x: x[0])
@@ -83,10 +87,44 @@ def calculate_measure_nps(measure_notes, measure_time_data):
     measure_seconds = calculate_accumulated_measure_time(bpms, stops)
 
     # Tally up notes, holds, and rolls
-    note_count = 0
-    for subdivision in measure_notes:
-        for note in subdivision:
-            if note in NOTE_TYPES:
-                note_count += 1
+    if note_count is None:
+        note_count = sum(row_info(subdivision).notes for subdivision in measure_notes)
 
     return float(note_count) / float(measure_seconds)
+
+
+class TimingMap(object):
+    """
+    Converts beats to seconds for a whole song, in O(log n) per lookup.
+
+    A note on the beat of a stop is hit before the stop, so a stop only
+    delays notes after its beat.
+    """
+
+    def __init__(self, bpm_map, stop_map):
+        """
+        :param bpm_map:     [[0.0, 150.0], [160.0, 200.0], ..., [<beat>, <bpm>]]
+        :param stop_map:    [[16.0, 0.1], [32.0, 0.4], ..., [<beat>, <stop len (seconds)>]]
+        """
+        self.bpm_beats = []
+        self.bpm_seconds = []   # seconds elapsed at each bpm change, ignoring stops
+        self.bpms = []
+        seconds = 0.0
+        last_beat, last_bpm = bpm_map[0]
+        for beat, bpm in bpm_map:
+            seconds += 60 * (beat - last_beat) / last_bpm
+            self.bpm_beats.append(beat)
+            self.bpm_seconds.append(seconds)
+            self.bpms.append(bpm)
+            last_beat, last_bpm = beat, bpm
+
+        self.stop_beats = [beat for beat, _ in stop_map]
+        self.stop_seconds = [0.0]   # total length of the first i stops
+        for _, stop in stop_map:
+            self.stop_seconds.append(self.stop_seconds[-1] + stop)
+
+    def seconds_at(self, beat):
+        beat = float(beat)
+        i = max(bisect_right(self.bpm_beats, beat) - 1, 0)
+        seconds = self.bpm_seconds[i] + 60 * (beat - self.bpm_beats[i]) / self.bpms[i]
+        return seconds + self.stop_seconds[bisect_left(self.stop_beats, beat)]